@@ -0,0 +1,128 @@
+"""
+Synthetic API payloads shaped like the responses of the Tiktalik API,
+shared by the benchmark scripts.
+"""
+import random
+import uuid as _uuid
+
+
+def _uuid4(rnd):
+    return str(_uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def networks(count=4, seed=1):
+    rnd = random.Random(seed)
+    return [
+        {
+            "uuid": _uuid4(rnd),
+            "name": "net%d" % i,
+            "net": "10.%d.0.0/16" % i,
+            "owner": "system" if i == 0 else "user",
+            "domainname": "net%d.example.tiktalik.com" % i,
+            "public": i == 0,
+        }
+        for i in range(count)
+    ]
+
+
+def images(count=6, seed=2):
+    rnd = random.Random(seed)
+    return [
+        {
+            "uuid": _uuid4(rnd),
+            "name": "Image %d" % i,
+            "owner": "system",
+            "type": "image",
+            "is_public": True,
+            "description": "Synthetic image number %d" % i,
+            "create_time": "2020-01-%02d 12:00:00" % (i + 1),
+        }
+        for i in range(count)
+    ]
+
+
+def instances(count, actions=5, seed=3, nets=None, imgs=None):
+    """
+    Return `count` instance dicts, as returned by GET /instance with
+    actions=true and vpsimage=true.
+    """
+
+    rnd = random.Random(seed)
+    nets = nets or networks()
+    imgs = imgs or images()
+
+    ret = []
+    for i in range(count):
+        image = rnd.choice(imgs)
+        interfaces = []
+        for seq, net in enumerate(rnd.sample(nets, 2)):
+            interfaces.append(
+                {
+                    "uuid": _uuid4(rnd),
+                    "network": dict(net),
+                    "mac": "e6:95:%02x:%02x:%02x:%02x"
+                    % tuple(rnd.getrandbits(8) for _ in range(4)),
+                    "ip": "10.%s.%d.%d"
+                    % (net["net"].split(".")[1], i // 250, i % 250 + 2),
+                    "seq": seq,
+                }
+            )
+        ret.append(
+            {
+                "uuid": _uuid4(rnd),
+                "hostname": "host-%05d" % i,
+                "owner": "user",
+                "vpsimage_uuid": image["uuid"],
+                "state": 12,
+                "running": rnd.random() > 0.1,
+                "interfaces": interfaces,
+                "actions": [
+                    {
+                        "uuid": _uuid4(rnd),
+                        "description": "Start instance",
+                        "start_time": "2020-02-%02d 10:00:00" % (a + 1),
+                        "end_time": "2020-02-%02d 10:00:30" % (a + 1),
+                        "progress": 100,
+                    }
+                    for a in range(actions)
+                ],
+                "vpsimage": dict(image),
+                "default_password": None,
+                "service_name": "TC_UNIT_%d" % rnd.choice((1, 2, 4)),
+                "gross_cost_per_hour": 0.05,
+            }
+        )
+    return ret
+
+
+def loadbalancers(count, backends=4, history=5, seed=4):
+    rnd = random.Random(seed)
+    return [
+        {
+            "uuid": _uuid4(rnd),
+            "name": "lb%d" % i,
+            "type": "HTTP",
+            "address": "185.0.%d.%d" % (i // 250, i % 250 + 1),
+            "port": 80,
+            "enabled": True,
+            "domains": ["www%d.example.com" % i],
+            "backends": [
+                {
+                    "uuid": _uuid4(rnd),
+                    "ip": "10.1.%d.%d" % (i % 250, b + 2),
+                    "port": 8080,
+                    "weight": 10,
+                }
+                for b in range(backends)
+            ],
+            "monitor": {"interval": 10, "timeout": 5, "path": "/"},
+            "history": [
+                {
+                    "time": "2020-02-%02d 10:00:00" % (h + 1),
+                    "description": "Backend added",
+                }
+                for h in range(history)
+            ],
+        }
+        for i in range(count)
+    ]
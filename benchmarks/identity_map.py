@@ -0,0 +1,51 @@
+"""
+Memory used by a synthetic fleet of Instances (with VPS images), built with
+and without an IdentityMap that shares Network and VPSImage objects.
+
+Run from the repository root:
+
+    python benchmarks/identity_map.py [-n INSTANCES]
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fleet
+from tiktalik.identitymap import IdentityMap
+from tiktalik.computing.objects import Instance
+
+
+def measure(payload, identity_map):
+    gc.collect()
+    tracemalloc.start()
+    instances = [Instance(None, dict(i), identity_map) for i in payload]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return instances, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--instances", type=int, default=5000)
+    args = parser.parse_args()
+
+    payload = fleet.instances(args.instances)
+
+    plain, plain_size = measure(payload, None)
+    del plain
+    identity_map = IdentityMap()
+    interned, interned_size = measure(payload, identity_map)
+
+    print("instances           %10d" % args.instances)
+    print("without identity map %9.1f MiB" % (plain_size / 2.0 ** 20))
+    print("with identity map    %9.1f MiB" % (interned_size / 2.0 ** 20))
+    print("shared objects      %10d" % len(identity_map))
+    print("saved                %9.1f%%" % (100.0 * (1 - interned_size / plain_size)))
+
+
+if __name__ == "__main__":
+    main()
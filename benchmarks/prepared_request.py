@@ -0,0 +1,49 @@
+"""
+Microbenchmark: CPU cost of building and signing a polling request
+(GET /instance/<uuid>?actions=...), from scratch vs. with a PreparedRequest.
+
+Run from the repository root:
+
+    python benchmarks/prepared_request.py [-n NUMBER]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tiktalik.computing import ComputingConnection
+
+UUID = "4d6a8b4e-7a4b-4cbb-9d39-0d58c6a1c0f2"
+QUERY = {"actions": False, "vpsimage": True, "cost": False}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    conn = ComputingConnection("APIKEY", "c2VjcmV0c2VjcmV0c2VjcmV0")
+    prepared = conn.prepare("GET", "/instance/" + UUID, query_params=QUERY)
+
+    def from_scratch():
+        p = conn._prepare(
+            "GET", conn.base_url() + "/instance/" + UUID, query_params=QUERY
+        )
+        conn._add_auth_header(p.method, p.path, dict(p.headers))
+
+    def reuse_prepared():
+        conn._sign_prepared(prepared)
+
+    results = []
+    for name, fn in (("from scratch", from_scratch), ("prepared", reuse_prepared)):
+        best = min(timeit.repeat(fn, number=args.number, repeat=5))
+        results.append(best / args.number * 1e6)
+        print("%-14s %8.2f us/call" % (name, results[-1]))
+
+    print("speedup        %8.2fx" % (results[0] / results[1]))
+
+
+if __name__ == "__main__":
+    main()
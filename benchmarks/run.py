@@ -0,0 +1,227 @@
+"""
+Offline microbenchmarks of the client-side hot paths: request parameter
+encoding, request signing, JSON decoding and building API objects, on
+synthetic payloads at several fleet sizes. No network access is needed.
+
+Run from the repository root:
+
+    python benchmarks/run.py                          # print results
+    python benchmarks/run.py --save benchmarks/baseline.json
+    python benchmarks/run.py --compare benchmarks/baseline.json --threshold 15
+
+In compare mode the exit status is 1 if any benchmark got slower than the
+baseline by more than the threshold (in percent). Baselines are machine
+specific; regenerate them with --save on the machine that runs comparisons.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fleet
+from tiktalik.apiobject import APIObject
+from tiktalik.computing import ComputingConnection
+from tiktalik.computing.objects import Instance
+from tiktalik.computing.refresh import InstanceRefresher
+from tiktalik.loadbalancer.objects import LoadBalancer
+
+DEFAULT_SIZES = (10, 100, 1000)
+
+
+def _connection():
+    return ComputingConnection("APIKEY", "c2VjcmV0c2VjcmV0c2VjcmV0")
+
+
+def bench_encode_params(size):
+    """Form body encoding of a create_instance-like call with `size` networks."""
+
+    conn = _connection()
+    params = {
+        "hostname": "host-00001",
+        "size": "1s",
+        "image_uuid": "4d6a8b4e-7a4b-4cbb-9d39-0d58c6a1c0f2",
+        "networks[]": ["%08d-0000-4000-8000-000000000000" % i for i in range(size)],
+    }
+    return lambda: conn._prepare("POST", "/api/v1/computing/instance", params=params)
+
+
+def bench_encode_query(size):
+    """Path quoting and query string encoding with `size` query parameters."""
+
+    conn = _connection()
+    query = dict(("flag%d" % i, i % 2 == 0) for i in range(size))
+    return lambda: conn._prepare(
+        "GET", "/api/v1/computing/instance/x", query_params=query
+    )
+
+
+def bench_sign(size):
+    """Canonical string and HMAC signature, for a body of `size` parameters."""
+
+    conn = _connection()
+    params = dict(("key%d" % i, "value%d" % i) for i in range(size))
+    prepared = conn._prepare("POST", "/api/v1/computing/instance", params=params)
+
+    def run():
+        headers = dict(prepared.headers, date="Mon, 01 Jan 2024 00:00:00 GMT")
+        S = conn._canonical_string(prepared.method, prepared.path, headers)
+        conn._sign_string(S)
+
+    return run
+
+
+def bench_json_instances(size):
+    """json.loads of a list_instances reply with `size` instances."""
+
+    data = json.dumps(fleet.instances(size)).encode("utf8")
+    return lambda: json.loads(data)
+
+
+def bench_apiobject(size):
+    """APIObject.__init__ of `size` flat objects."""
+
+    payload = fleet.networks(size)
+    return lambda: [APIObject(None, n) for n in payload]
+
+
+def bench_build_instances(size):
+    """Instance.__init__ (interfaces, actions, image) of `size` instances."""
+
+    payload = fleet.instances(size)
+    return lambda: [Instance(None, dict(i)) for i in payload]
+
+
+def bench_refresh_instances(size):
+    """InstanceRefresher.update of `size` instances, 1% of them changed."""
+
+    payload = fleet.instances(size)
+    refresher = InstanceRefresher(None)
+    refresher.update(None, [dict(i) for i in payload])
+    step = [0]
+
+    def run():
+        step[0] += 1
+        response = [dict(i) for i in payload]
+        for i in response[::100]:
+            i["state"] = step[0]
+        refresher.update(None, response)
+
+    return run
+
+
+def bench_build_loadbalancers(size):
+    """LoadBalancer.__init__ (backends, monitor, history) of `size` balancers."""
+
+    payload = fleet.loadbalancers(size)
+    return lambda: [LoadBalancer(None, dict(i)) for i in payload]
+
+
+BENCHMARKS = [
+    ("encode_params", bench_encode_params),
+    ("encode_query", bench_encode_query),
+    ("sign", bench_sign),
+    ("json_instances", bench_json_instances),
+    ("apiobject", bench_apiobject),
+    ("build_instances", bench_build_instances),
+    ("refresh_instances", bench_refresh_instances),
+    ("build_loadbalancers", bench_build_loadbalancers),
+]
+
+
+def measure(fn, repeat):
+    """
+    Best time of one call of `fn`, in microseconds.
+    """
+
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def run(sizes, repeat, only=None):
+    results = {}
+    for name, factory in BENCHMARKS:
+        if only and not any(o in name for o in only):
+            continue
+        for size in sizes:
+            key = "%s[%d]" % (name, size)
+            results[key] = measure(factory(size), repeat)
+            print("%-28s %12.2f us" % (key, results[key]))
+            sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the difference against `baseline`, return the names of benchmarks
+    that regressed by more than `threshold` percent.
+    """
+
+    regressions = []
+    print()
+    print("%-28s %12s %12s %8s" % ("benchmark", "baseline us", "current us", "change"))
+    for key, current in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            print("%-28s %12s %12.2f %8s" % (key, "-", current, "new"))
+            continue
+        change = (current - base) / base * 100
+        flag = ""
+        if change > threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print("%-28s %12.2f %12.2f %+7.1f%%%s" % (key, base, current, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(s) for s in DEFAULT_SIZES),
+        help="comma separated fleet sizes (default: %(default)s)",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "-k", dest="only", action="append", help="run benchmarks matching this name"
+    )
+    parser.add_argument("--save", metavar="FILE", help="store results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="allowed slowdown in percent in compare mode (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    results = run(sizes, args.repeat, args.only)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Throughput of tiktalik.serialization (dumps/loads of whole object lists)
+compared to plain pickle of the raw API dicts.
+
+Run from the repository root:
+
+    python benchmarks/serialization.py [-n INSTANCES]
+"""
+import argparse
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fleet
+from tiktalik import serialization
+from tiktalik.identitymap import IdentityMap
+from tiktalik.computing.objects import Instance
+
+
+def best_of(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, count, dump, load):
+    data = dump()
+    dump_time = best_of(dump)
+    load_time = best_of(lambda: load(data))
+    print(
+        "%-28s %9.0f obj/s dump %9.0f obj/s load %8.1f KiB"
+        % (name, count / dump_time, count / load_time, len(data) / 1024.0)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--instances", type=int, default=5000)
+    args = parser.parse_args()
+
+    raw = fleet.instances(args.instances)
+    instances = [Instance(None, dict(i)) for i in raw]
+    identity_map = IdentityMap()
+    interned = [Instance(None, dict(i), identity_map) for i in raw]
+    n = len(raw)
+
+    report(
+        "pickle, raw dicts",
+        n,
+        lambda: pickle.dumps(raw, pickle.HIGHEST_PROTOCOL),
+        pickle.loads,
+    )
+    report(
+        "pickle, raw dicts + build",
+        n,
+        lambda: pickle.dumps(raw, pickle.HIGHEST_PROTOCOL),
+        lambda d: [Instance(None, i) for i in pickle.loads(d)],
+    )
+    for codec in ("pickle", "msgpack"):
+        if codec == "msgpack" and serialization.msgpack is None:
+            print("%-28s skipped, msgpack is not installed" % "tiktalik, msgpack")
+            continue
+        report(
+            "tiktalik, %s" % codec,
+            n,
+            lambda: serialization.dumps(instances, codec),
+            serialization.loads,
+        )
+        report(
+            "tiktalik, %s, interned" % codec,
+            n,
+            lambda: serialization.dumps(interned, codec),
+            serialization.loads,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -20,12 +20,18 @@
 
 # -*- coding: utf8 -*-
 
+import copy
+from collections import deque
+
 
 class APIObject:
     """
     Base class for all objects returned by the API.
     """
 
+    # Objects loaded from a pickle have no connection until rebind() is called.
+    conn = None
+
     def __init__(self, conn, json_dict, defaults=dict()):
         super(APIObject, self).__init__()
 
@@ -37,3 +43,41 @@ class APIObject:
         for key, value in defaults.items():
             if key not in json_dict:
                 setattr(self, key, value)
+
+    def __getstate__(self):
+        # the connection is never serialized, see rebind()
+        state = self.__dict__.copy()
+        state.pop("conn", None)
+        return state
+
+    # copies keep the connection, only pickling leaves it out
+
+    def __copy__(self):
+        obj = self.__class__.__new__(self.__class__)
+        obj.__dict__.update(self.__dict__)
+        return obj
+
+    def __deepcopy__(self, memo):
+        obj = self.__class__.__new__(self.__class__)
+        memo[id(self)] = obj
+        # the connection is shared, not copied
+        memo.setdefault(id(self.conn), self.conn)
+        for key, value in self.__dict__.items():
+            obj.__dict__[key] = copy.deepcopy(value, memo)
+        return obj
+
+    def rebind(self, conn):
+        """
+        Attach this object and all objects nested in it to `conn`. Used after
+        unpickling, as connections are not serialized.
+        """
+
+        self.conn = conn
+        for value in self.__dict__.values():
+            if isinstance(value, APIObject):
+                value.rebind(conn)
+            elif isinstance(value, (list, tuple, deque)):
+                for v in value:
+                    if isinstance(v, APIObject):
+                        v.rebind(conn)
+        return self
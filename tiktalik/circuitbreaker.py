@@ -0,0 +1,206 @@
+"""Module tiktalik.circuitbreaker"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import time
+import threading
+from collections import deque
+
+from .error import TiktalikCircuitOpenError
+
+__all__ = ["CircuitBreaker", "CLOSED", "OPEN", "HALF_OPEN"]
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class _Circuit:
+    def __init__(self, window):
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=window)
+        self.failures = 0
+        self.opened_at = None
+        self.probes = 0
+        self.probe_successes = 0
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast when the API is degraded, instead of letting each of
+    them wait for the full timeout.
+
+    Circuits are kept per key (host, family, kind), where family is the API
+    part ("computing", "loadbalancer") and kind is "read" for GET requests and
+    "write" for everything else. One CircuitBreaker may be shared by
+    many connections.
+
+    A circuit opens when, among the last `window` calls (and at least
+    `min_calls`), the fraction of failures reaches `failure_rate`. A failure
+    is a network error, a timeout or an HTTP 5xx response. An open circuit
+    rejects calls with TiktalikCircuitOpenError for `open_for` seconds, then
+    becomes half-open and lets through up to `probes` concurrent calls.
+    If all of them succeed the circuit closes, the first failure opens it again.
+
+    :type on_state_change: callable
+    :param on_state_change: called as on_state_change(key, old_state, new_state)
+    """
+
+    def __init__(
+        self,
+        failure_rate=0.5,
+        min_calls=10,
+        window=50,
+        open_for=30.0,
+        probes=1,
+        on_state_change=None,
+    ):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_for = open_for
+        self.probes = probes
+        self.on_state_change = on_state_change
+
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def state(self, key):
+        """
+        :rtype: string
+        :return: one of CLOSED, OPEN, HALF_OPEN
+        """
+
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit.state if circuit else CLOSED
+
+    def states(self):
+        """
+        :rtype: dict
+        :return: key -> state of all known circuits
+        """
+
+        with self._lock:
+            return dict((k, c.state) for (k, c) in self._circuits.items())
+
+    def before(self, key):
+        """
+        Called before a request is sent. Raises TiktalikCircuitOpenError if
+        the circuit doesn't let the request through.
+        """
+
+        changed = None
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None:
+                circuit = self._circuits[key] = _Circuit(self.window)
+
+            if circuit.state == OPEN:
+                retry_after = circuit.opened_at + self.open_for - time.monotonic()
+                if retry_after > 0:
+                    raise TiktalikCircuitOpenError(key, retry_after)
+                changed = self._transition(key, circuit, HALF_OPEN)
+
+            if circuit.state == HALF_OPEN:
+                if circuit.probes >= self.probes:
+                    raise TiktalikCircuitOpenError(key, 0)
+                circuit.probes += 1
+
+        self._notify(changed)
+
+    def record(self, key, success):
+        """
+        Called with the outcome of a request let through by before().
+        """
+
+        changed = None
+        with self._lock:
+            circuit = self._circuits[key]
+
+            if circuit.state == HALF_OPEN:
+                if not success:
+                    changed = self._transition(key, circuit, OPEN)
+                else:
+                    circuit.probe_successes += 1
+                    if circuit.probe_successes >= self.probes:
+                        changed = self._transition(key, circuit, CLOSED)
+                    else:
+                        circuit.probes -= 1
+            elif circuit.state == CLOSED:
+                if len(circuit.outcomes) == circuit.outcomes.maxlen:
+                    circuit.failures -= not circuit.outcomes[0]
+                circuit.outcomes.append(success)
+                circuit.failures += not success
+
+                calls = len(circuit.outcomes)
+                if (
+                    calls >= self.min_calls
+                    and circuit.failures >= self.failure_rate * calls
+                ):
+                    changed = self._transition(key, circuit, OPEN)
+
+        self._notify(changed)
+
+    def release(self, key):
+        """
+        Called instead of record() for a request let through by before() that
+        ended without telling anything about the server, eg. because the
+        caller's deadline expired.
+        """
+
+        with self._lock:
+            circuit = self._circuits[key]
+            if circuit.state == HALF_OPEN and circuit.probes:
+                circuit.probes -= 1
+
+    def reset(self, key=None):
+        """
+        Close the circuit for `key`, or all circuits.
+        """
+
+        with self._lock:
+            keys = [key] if key is not None else list(self._circuits)
+            changes = [
+                self._transition(k, self._circuits[k], CLOSED)
+                for k in keys
+                if k in self._circuits
+            ]
+
+        for change in changes:
+            self._notify(change)
+
+    def _transition(self, key, circuit, state):
+        old = circuit.state
+        circuit.state = state
+        circuit.probes = 0
+        circuit.probe_successes = 0
+        if state == OPEN:
+            circuit.opened_at = time.monotonic()
+        elif state == CLOSED:
+            circuit.outcomes.clear()
+            circuit.failures = 0
+        return (key, old, state) if old != state else None
+
+    def _notify(self, change):
+        if change is not None and self.on_state_change is not None:
+            self.on_state_change(*change)
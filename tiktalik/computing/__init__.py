@@ -19,3 +19,6 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from .connection import ComputingConnection
+from .topology import NetworkTopology
+from .loader import BlockDeviceLoader
+from .backup import BackupOrchestrator
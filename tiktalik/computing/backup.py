@@ -0,0 +1,366 @@
+"""Module tiktalik.computing.backup"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import time
+import datetime
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from ..error import TiktalikTimeoutError
+from ..deadline import current_deadline, deadline
+from ..scheduler import caller_priority, priority
+
+# BackupJob states
+PENDING = "pending"
+STOPPING = "stopping"
+BACKING_UP = "backing_up"
+STARTING = "starting"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class BackupJob:
+    """
+    Backup of a single Instance, as run by BackupOrchestrator.
+
+    Attributes:
+        instance: Instance
+        group: group key of the instance, see BackupOrchestrator(group)
+        state: string - one of PENDING, STOPPING, BACKING_UP, STARTING, DONE,
+               FAILED or SKIPPED (not started before the maintenance
+               window closed or the deadline expired)
+        backup_name: string
+        image: VPSImage - the backup, once it's done
+        pruned: List[VPSImage] - older backups deleted after this one
+        error: Exception - why the job failed
+        downtime: float - seconds the instance was stopped for this backup
+    """
+
+    def __init__(self, instance, group):
+        self.instance = instance
+        self.group = group
+        self.state = PENDING
+        self.backup_name = None
+        self.image = None
+        self.pruned = []
+        self.error = None
+        self.downtime = None
+
+    def __str__(self):
+        return "<BackupJob: %s %s>" % (self.instance.hostname, self.state)
+
+
+class BackupOrchestrator:
+    """
+    Backs up many instances. Instance.backup() needs a stopped instance, so
+    every instance goes through: stop, wait until stopped, backup, wait for
+    the backup image, start (if it was running), wait until running.
+
+        orchestrator = BackupOrchestrator(
+            conn,
+            concurrency=4,
+            group=lambda i: i.hostname.rstrip("0123456789"),
+            max_down_per_group=1,
+            window=(datetime.time(1, 0), datetime.time(5, 0)),
+            keep=7,
+        )
+        jobs = orchestrator.run(conn.list_instances())
+
+    :type concurrency: int
+    :param concurrency: number of instances processed at the same time
+
+    :type group: callable
+    :param group: group(instance) -> key; at most `max_down_per_group`
+                  instances with the same key are down at the same time
+
+    :type window: tuple
+    :param window: (start, end) datetime.time in local time, may wrap around
+                   midnight. Instances are only stopped within the window,
+                   those not started before it closes are SKIPPED.
+
+    :type keep: int
+    :param keep: after a successful backup, delete the older backups of the
+                 instance made by this class, keeping the `keep` newest ones
+
+    :type poll_interval: float
+    :param poll_interval: seconds between state checks
+
+    :type timeout: float
+    :param timeout: time limit of each wait (stop, backup, start), in seconds;
+                    exceeding it fails the job with TiktalikTimeoutError
+
+    A deadline active in the thread calling run() applies to all jobs, except
+    for starting an instance again after its backup failed. So does the
+    priority set with tiktalik.scheduler.priority(), eg. BULK.
+    """
+
+    def __init__(
+        self,
+        conn,
+        concurrency=4,
+        group=None,
+        max_down_per_group=1,
+        window=None,
+        keep=None,
+        poll_interval=10.0,
+        timeout=3600.0,
+    ):
+        self.conn = conn
+        self.concurrency = concurrency
+        self.group = group
+        self.max_down_per_group = max_down_per_group
+        self.window = window
+        self.keep = keep
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        self._down = {}
+        self._cond = threading.Condition()
+        self._images = None
+        self._images_at = None
+        self._images_lock = threading.Lock()
+
+    def run(self, instances):
+        """
+        Back up `instances` and wait until all are done.
+
+        :rtype: list
+        :return: list of BackupJob objects, in the order of `instances`
+        """
+
+        jobs = [
+            BackupJob(i, self.group(i) if self.group is not None else None)
+            for i in instances
+        ]
+
+        # interleave groups, so that workers rarely wait for a group slot
+        # while instances of other groups could be processed
+        groups = OrderedDict()
+        for job in jobs:
+            groups.setdefault(job.group, []).append(job)
+        order = [
+            job
+            for batch in itertools.zip_longest(*groups.values())
+            for job in batch
+            if job is not None
+        ]
+
+        budget = current_deadline()
+        level = caller_priority()
+
+        def run_job(job):
+            with priority(*level):
+                return self._run_job(job, budget)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(run_job, order))
+        return jobs
+
+    def backup_name(self, instance):
+        """
+        :rtype: string
+        :return: name of a new backup of `instance`; the prefix identifies
+                 backups made by this class for pruning
+        """
+
+        return "%s%s" % (
+            self._prefix(instance),
+            datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S"),
+        )
+
+    def _prefix(self, instance):
+        # hostnames aren't unique
+        return "%s-%s-backup-" % (instance.hostname, instance.uuid)
+
+    def _in_window(self):
+        if self.window is None:
+            return True
+        start, end = self.window
+        now = datetime.datetime.now().time()
+        if start <= end:
+            return start <= now < end
+        return now >= start or now < end
+
+    def _acquire_slot(self, job):
+        """
+        Wait until the job's group may have another instance down. Return
+        False if the maintenance window closed in the meantime.
+        """
+
+        budget = current_deadline()
+        with self._cond:
+            while True:
+                if not self._in_window() or (budget is not None and budget.expired()):
+                    return False
+                if (
+                    job.group is None
+                    or self._down.get(job.group, 0) < self.max_down_per_group
+                ):
+                    self._down[job.group] = self._down.get(job.group, 0) + 1
+                    return True
+                self._cond.wait(_sleep_time(self.poll_interval, budget))
+
+    def _release_slot(self, job):
+        with self._cond:
+            self._down[job.group] -= 1
+            self._cond.notify_all()
+
+    def _run_job(self, job, budget=None):
+        with _within(budget):
+            if not self._acquire_slot(job):
+                job.state = SKIPPED
+                return job
+
+        instance = job.instance
+        stopped_at = None
+        restart = False
+        try:
+            with _within(budget):
+                current = self.conn.get_instance(instance.uuid)
+                restart = current.running
+
+                if current.running:
+                    job.state = STOPPING
+                    instance.stop()
+                    stopped_at = time.monotonic()
+                    self._wait(
+                        "stop",
+                        lambda: not self.conn.get_instance(instance.uuid).running,
+                    )
+                else:
+                    stopped_at = time.monotonic()
+
+                job.state = BACKING_UP
+                job.backup_name = self.backup_name(instance)
+                instance.backup(job.backup_name)
+                job.image = self._wait(
+                    "backup", lambda: self._find_backup(instance, job)
+                )
+
+                if restart:
+                    job.state = STARTING
+                    instance.start()
+                    restart = False
+                    self._wait(
+                        "start", lambda: self.conn.get_instance(instance.uuid).running
+                    )
+
+            job.downtime = time.monotonic() - stopped_at
+            job.state = DONE
+        except Exception as e:
+            job.error = e
+            job.state = FAILED
+            if restart:
+                # don't leave an instance down because its backup failed; the
+                # deadline is left behind, it may be what failed the backup
+                try:
+                    instance.start()
+                except Exception:
+                    pass
+        finally:
+            self._release_slot(job)
+
+        if job.state == DONE and self.keep is not None:
+            try:
+                with _within(budget):
+                    job.pruned = self._prune(instance)
+            except Exception as e:
+                job.error = e
+
+        return job
+
+    def _wait(self, what, check):
+        """
+        Call `check` every poll_interval until it returns a true value, which
+        is returned. Raise TiktalikTimeoutError with `what` ("stop", "backup"
+        or "start") as the phase after `timeout` seconds, or when the active
+        deadline expires.
+        """
+
+        budget = current_deadline()
+        limit = time.monotonic() + self.timeout
+        while True:
+            value = check()
+            if value:
+                return value
+            if budget is not None and budget.expired():
+                raise TiktalikTimeoutError(what, budget.timeout)
+            if time.monotonic() >= limit:
+                raise TiktalikTimeoutError(what, self.timeout)
+            time.sleep(_sleep_time(self.poll_interval, budget))
+
+    def _list_images(self, refresh=False):
+        """
+        List images, shared by all jobs: fetched at most once per poll_interval,
+        however many backups are being waited for.
+        """
+
+        with self._images_lock:
+            now = time.monotonic()
+            if (
+                refresh
+                or self._images is None
+                or now - self._images_at >= self.poll_interval
+            ):
+                self._images = self.conn.list_images()
+                self._images_at = now
+            return self._images
+
+    def _find_backup(self, instance, job):
+        for image in self._list_images():
+            if image.type == "backup" and image.name == job.backup_name:
+                return image
+        return None
+
+    def _prune(self, instance):
+        prefix = self._prefix(instance)
+        backups = [
+            i
+            for i in self._list_images(refresh=True)
+            if i.type == "backup" and (i.name or "").startswith(prefix)
+        ]
+        backups.sort(key=lambda i: i.name, reverse=True)
+
+        pruned = []
+        for image in backups[self.keep :]:
+            self.conn.delete_image(image.uuid)
+            pruned.append(image)
+        return pruned
+
+
+@contextmanager
+def _within(budget):
+    if budget is None:
+        yield
+    else:
+        with deadline(budget):
+            yield
+
+
+def _sleep_time(interval, budget):
+    if budget is None:
+        return interval
+    return max(0, min(interval, budget.remaining()))
@@ -23,17 +23,43 @@ import json
 from .objects import *
 from ..error import TiktalikAPIError
 from ..connection import TiktalikAuthConnection
+from ..identitymap import intern
+from ..history import HistoryTracker
+from .refresh import InstanceRefresher
+from ..tracing import traced
+from ..filters import compile_filter
 
 
 class ComputingConnection(TiktalikAuthConnection):
     """
     Performs API calls. All method raise TiktalikAPIError on errors.
+
+    Set `identity_map` to a tiktalik.identitymap.IdentityMap to share Network
+    and VPSImage objects between all objects built by this connection.
     """
 
+    identity_map = None
+    _action_history = None
+    _instance_refresher = None
+
+    # Fields the API filters on when passed as query parameters, per
+    # resource ("instance", "network", "image"); other filter conditions are
+    # evaluated locally.
+    server_filters = {}
+
     def base_url(self):
         return "/api/v1/computing"
 
-    def list_instances(self, actions=False, vpsimage=False, cost=False):
+    @traced
+    def list_instances(
+        self,
+        actions=False,
+        vpsimage=False,
+        cost=False,
+        identity_map=None,
+        history_limit=None,
+        filter=None,
+    ):
         """
         List all instances.
 
@@ -46,29 +72,111 @@ class ComputingConnection(TiktalikAuthConnection):
         :type cost: boolean
         :param cost: include cost per hour in each Instance
 
+        :type identity_map: IdentityMap
+        :param identity_map: intern Networks and VPSImages of this call in the
+                             given map instead of the connection's one
+
+        :type history_limit: int
+        :param history_limit: with `actions`, keep only this many newest actions
+                              per Instance, in an ActionHistory. Histories are
+                              kept by the connection between calls with the same
+                              limit, so a repeated call only builds Operation
+                              objects for actions it hasn't seen before.
+
+        :type filter: dict or callable
+        :param filter: only return instances matching it, checked before any
+                       object is built; see tiktalik.filters.compile_filter()
+
         :rtype: list
         :return: list of Instance objects
         """
 
+        match, query = compile_filter(filter, self.server_filters.get("instance", ()))
+        query.update(actions=actions, vpsimage=vpsimage, cost=cost)
+        response = self.request("GET", "/instance", query_params=query)
+        matching = response if match is None else [i for i in response if match(i)]
+
+        if actions and history_limit:
+            self._track_actions(matching, response, history_limit)
+
+        return [Instance(self, i, identity_map) for i in matching]
+
+    @traced
+    def refresh_instances(
+        self,
+        actions=False,
+        vpsimage=False,
+        cost=False,
+        identity_map=None,
+        history_limit=None,
+    ):
+        """
+        List all instances, reusing the Instance objects returned by the
+        previous call with the same `actions`, `vpsimage`, `cost` and
+        `history_limit`. Unchanged instances are returned as they were,
+        changed ones are patched in place, objects are built only for
+        new instances.
+
+        Arguments are the same as for list_instances().
+
+        :rtype: RefreshResult
+        :return: the instances and counts of added, changed, unchanged and
+                 removed ones
+        """
+
         response = self.request(
             "GET",
             "/instance",
             query_params={"actions": actions, "vpsimage": vpsimage, "cost": cost},
         )
 
-        return [Instance(self, i) for i in response]
+        key = (actions, vpsimage, cost, history_limit)
+        refresher = self._instance_refresher
+        if refresher is None or refresher.key != key:
+            refresher = self._instance_refresher = InstanceRefresher(key)
+
+        prepare = None
+        if actions and history_limit:
+            prepare = lambda changed: self._track_actions(
+                changed, response, history_limit
+            )
+
+        return refresher.update(self, response, identity_map, prepare)
+
+    def _track_actions(self, changed, response, history_limit):
+        """
+        Replace raw actions of instances in `changed` with their ActionHistory,
+        forget histories of instances missing from `response`.
+        """
 
-    def list_networks(self):
+        tracker = self._action_history
+        if tracker is None or tracker.limit != history_limit:
+            tracker = self._action_history = HistoryTracker(
+                history_limit, Operation, _fetch_instance_actions
+            )
+        for i in changed:
+            i["actions"] = tracker.update(self, i["uuid"], i.get("actions"))
+        tracker.retain(i["uuid"] for i in response)
+
+    @traced
+    def list_networks(self, filter=None):
         """
         List all available networks.
 
+        :type filter: dict or callable
+        :param filter: only return networks matching it, see list_instances()
+
         :rtype: list
         :return: list of Network objects
         """
 
-        response = self.request("GET", "/network")
-        return [Network(self, i) for i in response]
+        match, query = compile_filter(filter, self.server_filters.get("network", ()))
+        response = self.request("GET", "/network", query_params=query or None)
+        return [
+            intern(Network, self, i) for i in response if match is None or match(i)
+        ]
 
+    @traced
     def create_network(self, name):
         """
         Create a new network.
@@ -91,17 +199,25 @@ class ComputingConnection(TiktalikAuthConnection):
         response = self.request("POST", "/network", params)
         return Network(self, response)
 
-    def list_images(self):
+    @traced
+    def list_images(self, filter=None):
         """
         List all available VPS Images.
 
+        :type filter: dict or callable
+        :param filter: only return images matching it, see list_instances()
+
         :rtype: list
         :return: list of VPSImage objects
         """
 
-        response = self.request("GET", "/image")
-        return [VPSImage(self, i) for i in response]
+        match, query = compile_filter(filter, self.server_filters.get("image", ()))
+        response = self.request("GET", "/image", query_params=query or None)
+        return [
+            intern(VPSImage, self, i) for i in response if match is None or match(i)
+        ]
 
+    @traced
     def list_instance_interfaces(self, uuid):
         """
         List all interfaces attached to an Instance
@@ -116,6 +232,7 @@ class ComputingConnection(TiktalikAuthConnection):
         response = self.request("GET", "/instance/%s/interface" % uuid)
         return [VPSNetInterface(self, i) for i in response]
 
+    @traced
     def get_instance(self, uuid, actions=False, vpsimage=False, cost=False):
         """
         Fetch an Instance object from the server
@@ -136,6 +253,7 @@ class ComputingConnection(TiktalikAuthConnection):
         )
         return Instance(self, response)
 
+    @traced
     def get_instance_block_devices(self, uuid):
         """ Fetch an Instances block devices from the server
 
@@ -148,6 +266,7 @@ class ComputingConnection(TiktalikAuthConnection):
         response = self.request("GET", "/instance/" + uuid + "/blockdevice")
         return [BlockDevice(self, b) for b in response]
 
+    @traced
     def get_image(self, image_uuid):
         """
         Fetch a VPSImage object from the server
@@ -160,8 +279,9 @@ class ComputingConnection(TiktalikAuthConnection):
         """
 
         response = self.request("GET", "/image/" + image_uuid)
-        return VPSImage(self, response)
+        return intern(VPSImage, self, response)
 
+    @traced
     def create_instance(
         self, hostname, size, image_uuid, networks, ssh_key=None, disk_size_gb=None
     ):
@@ -201,6 +321,7 @@ class ComputingConnection(TiktalikAuthConnection):
 
         return self.request("POST", "/instance", params)
 
+    @traced
     def delete_instance(self, uuid):
         """
         Delete Tiktalik Instance specified by UUID.
@@ -210,6 +331,7 @@ class ComputingConnection(TiktalikAuthConnection):
         """
         self.request("DELETE", "/instance/%s" % uuid)
 
+    @traced
     def delete_image(self, uuid):
         """
         Delete a VPSImage specified by UUID.
@@ -220,6 +342,7 @@ class ComputingConnection(TiktalikAuthConnection):
 
         self.request("DELETE", "/image/%s" % uuid)
 
+    @traced
     def add_network_interface(self, instance_uuid, network_uuid, seq):
         """
         Attach a new network interface to an Instance. The Instance doesn't
@@ -244,6 +367,7 @@ class ComputingConnection(TiktalikAuthConnection):
             dict(network_uuid=network_uuid, seq=seq),
         )
 
+    @traced
     def remove_network_interface(self, instance_uuid, interface_uuid):
         """
         Detach a network interface from an Instance.
@@ -259,6 +383,7 @@ class ComputingConnection(TiktalikAuthConnection):
             "DELETE", "/instance/%s/interface/%s" % (instance_uuid, interface_uuid)
         )
 
+    @traced
     def rename_image(self, uuid, name):
         """
         Rename an image.
@@ -278,3 +403,9 @@ class ComputingConnection(TiktalikAuthConnection):
             "/image/%s/set_name" % uuid,
             params,
         )
+
+
+def _fetch_instance_actions(conn, uuid):
+    return conn.request(
+        "GET", "/instance/" + uuid, query_params={"actions": True}
+    ).get("actions", [])
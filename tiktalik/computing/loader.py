@@ -0,0 +1,172 @@
+"""Module tiktalik.computing.loader"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ..deadline import current_deadline, deadline
+from ..scheduler import caller_priority, priority
+
+
+class BlockDeviceLoader:
+    """
+    Batches Instance.block_devices loading. Instead of calling
+    Instance.load_block_devices() for every instance, which makes one request
+    at a time, queue instances with load() and call dispatch() once:
+
+        loader = BlockDeviceLoader(conn)
+        for instance in conn.list_instances():
+            loader.load(instance)
+        loader.dispatch()
+
+    Requests for the same UUID are made only once, at most `max_workers` at
+    the same time. Results are cached for `ttl` seconds and shared by all
+    instances with the same UUID, also across dispatch() calls.
+    """
+
+    def __init__(self, conn, max_workers=8, ttl=60.0):
+        self.conn = conn
+        self.max_workers = max_workers
+        self.ttl = ttl
+
+        self._pending = {}
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def load(self, instance):
+        """
+        Queue `instance` for loading. Its block_devices attribute is filled in
+        by the next dispatch().
+        """
+
+        with self._lock:
+            self._pending.setdefault(instance.uuid, []).append(instance)
+
+    def load_many(self, instances):
+        """
+        Queue all `instances` and dispatch immediately.
+
+        :rtype: dict
+        :return: see dispatch()
+        """
+
+        for instance in instances:
+            self.load(instance)
+        return self.dispatch()
+
+    def dispatch(self):
+        """
+        Fetch block devices of all queued instances that aren't cached yet and
+        fill in their block_devices attribute. A deadline active in the calling
+        thread applies to all requests made, and so does its priority (see
+        tiktalik.scheduler).
+
+        :rtype: dict
+        :return: UUID -> exception for instances that couldn't be loaded;
+                 their block_devices attribute is left unchanged
+        """
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        now = time.monotonic()
+        results = {}
+        missing = []
+        for uuid in pending:
+            cached = self._cached(uuid, now)
+            if cached is None:
+                missing.append(uuid)
+            else:
+                results[uuid] = cached
+
+        errors = {}
+        if missing:
+            budget = current_deadline()
+            level = caller_priority()
+
+            def get(uuid):
+                with priority(*level):
+                    if budget is None:
+                        return self.conn.get_instance_block_devices(uuid)
+                    with deadline(budget):
+                        return self.conn.get_instance_block_devices(uuid)
+
+            def fetch(uuid):
+                try:
+                    return uuid, get(uuid), None
+                except Exception as e:
+                    # eg. TiktalikAPIError or a network error, the other
+                    # instances are still loaded
+                    return uuid, None, e
+
+            workers = min(self.max_workers, len(missing))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for uuid, devices, error in executor.map(fetch, missing):
+                    if error is not None:
+                        errors[uuid] = error
+                        continue
+                    results[uuid] = devices
+                    with self._lock:
+                        self._cache[uuid] = (time.monotonic() + self.ttl, devices)
+
+        for uuid, instances in pending.items():
+            if uuid in results:
+                for instance in instances:
+                    instance.block_devices = results[uuid]
+
+        return errors
+
+    def get(self, uuid):
+        """
+        Return block devices of a single instance, from cache if possible.
+
+        :rtype: List[BlockDevice]
+        """
+
+        devices = self._cached(uuid, time.monotonic())
+        if devices is None:
+            devices = self.conn.get_instance_block_devices(uuid)
+            with self._lock:
+                self._cache[uuid] = (time.monotonic() + self.ttl, devices)
+        return devices
+
+    def invalidate(self, uuid=None):
+        """
+        Drop cached block devices of the instance `uuid`, or of all instances.
+        """
+
+        with self._lock:
+            if uuid is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(uuid, None)
+
+    def _cached(self, uuid, now):
+        with self._lock:
+            entry = self._cache.get(uuid)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._cache[uuid]
+                return None
+            return entry[1]
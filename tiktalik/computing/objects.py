@@ -22,6 +22,8 @@
 
 from ..error import TiktalikAPIError
 from ..apiobject import APIObject
+from ..identitymap import intern
+from ..history import ActionHistory
 
 
 class Network(APIObject):
@@ -65,10 +67,10 @@ class VPSNetInterface(APIObject):
         seq: int # interface sequence number: 0 for eth0, 1 for eth1, etc.
     """
 
-    def __init__(self, conn, json_dict):
+    def __init__(self, conn, json_dict, identity_map=None):
         super(VPSNetInterface, self).__init__(conn, json_dict)
 
-        self.network = Network(conn, self.network)
+        self.network = intern(Network, conn, self.network, identity_map)
 
     def __str__(self):
         return "<VPSNetInterface:(%s) ip=%s>" % (self.uuid, self.ip)
@@ -157,7 +159,7 @@ class Instance(APIObject):
         state: int,
         running: boolean
         interfaces: List[VPSNetInterface]
-        actions: List[Operation]
+        actions: List[Operation] -- or ActionHistory, see list_instances(history_limit)
         vpsimage: VPSImage,
         default_password: string,
         service_name: string,
@@ -165,7 +167,7 @@ class Instance(APIObject):
         block_devices: List[BlockDevice]  -- must be loaded by call .load_block_devices()
     """
 
-    def __init__(self, conn, json_dict):
+    def __init__(self, conn, json_dict, identity_map=None):
         defaults = {
             "actions": [],
             "vpsimage": None,
@@ -175,10 +177,38 @@ class Instance(APIObject):
 
         super(Instance, self).__init__(conn, json_dict, defaults)
 
-        self.interfaces = [VPSNetInterface(conn, i) for i in self.interfaces]
-        self.actions = [Operation(conn, o) for o in self.actions]
+        self.interfaces = [
+            VPSNetInterface(conn, i, identity_map) for i in self.interfaces
+        ]
+        if not isinstance(self.actions, ActionHistory):
+            self.actions = [Operation(conn, o) for o in self.actions]
         if self.vpsimage:
-            self.vpsimage = VPSImage(conn, self.vpsimage)
+            self.vpsimage = intern(VPSImage, conn, self.vpsimage, identity_map)
+
+    def _patch(self, json_dict, previous, identity_map=None):
+        """
+        Update the instance in place from `json_dict`, a newer version of
+        `previous`. Only attributes whose raw value changed are set; nested
+        objects are rebuilt only for changed interfaces, actions or image.
+        """
+
+        for key, value in json_dict.items():
+            if key in previous and previous[key] == value:
+                continue
+            if key == "interfaces":
+                value = [VPSNetInterface(self.conn, i, identity_map) for i in value]
+            elif key == "actions" and not isinstance(value, ActionHistory):
+                value = [Operation(self.conn, o) for o in value]
+            elif key == "vpsimage" and value:
+                value = intern(VPSImage, self.conn, value, identity_map)
+            setattr(self, key, value)
+
+        for key in previous:
+            if key not in json_dict:
+                if key in ("actions", "vpsimage", "gross_cost_per_hour"):
+                    setattr(self, key, [] if key == "actions" else None)
+                else:
+                    self.__dict__.pop(key, None)
 
     @classmethod
     def get_by_uuid(cls, conn, uuid, actions=False, vpsimage=False, cost=False):
@@ -201,11 +231,12 @@ class Instance(APIObject):
         """
 
         hostname = hostname.lower()
-        instances = [
-            i
-            for i in conn.list_instances(actions, vpsimage, cost)
-            if i.hostname.lower() == hostname
-        ]
+        instances = conn.list_instances(
+            actions,
+            vpsimage,
+            cost,
+            filter={"hostname": lambda h: h.lower() == hostname},
+        )
         if not instances:
             raise TiktalikAPIError(404)
         return instances
@@ -278,6 +309,8 @@ class Instance(APIObject):
     def load_block_devices(self):
         """
         (Re)load list of attached block devices
+
+        :seealso: BlockDeviceLoader for loading block devices of many instances
         """
 
         self.block_devices = self.conn.get_instance_block_devices(self.uuid)
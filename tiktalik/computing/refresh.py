@@ -0,0 +1,137 @@
+"""Module tiktalik.computing.refresh"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import threading
+
+from .objects import Instance
+
+
+class RefreshResult:
+    """
+    Outcome of ComputingConnection.refresh_instances().
+
+    Attributes:
+        instances: List[Instance] - all instances, in the order of the reply
+        added: int - instances built from scratch, their UUID wasn't seen before
+        changed: int - existing Instance objects patched in place
+        unchanged: int - existing Instance objects reused as they were
+        removed: int - instances no longer present on the server
+    """
+
+    def __init__(self, instances, added, changed, unchanged, removed):
+        self.instances = instances
+        self.added = added
+        self.changed = changed
+        self.unchanged = unchanged
+        self.removed = removed
+
+    def __iter__(self):
+        return iter(self.instances)
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __str__(self):
+        return "<RefreshResult: +%d ~%d =%d -%d>" % (
+            self.added,
+            self.changed,
+            self.unchanged,
+            self.removed,
+        )
+
+
+class InstanceRefresher:
+    """
+    Keeps the Instance objects of the previous refresh together with the raw
+    dicts they were built from. On the next refresh every raw element is
+    compared with the previous one of the same UUID: equal ones keep their
+    object, changed ones are patched in place, only new UUIDs are built.
+    The cost of a refresh grows with the number of changes, not with the
+    size of the fleet.
+
+    Instance objects are shared between refreshes - attributes set on them
+    by the application (eg. block_devices) survive unless the server reply
+    for that instance changes them.
+    """
+
+    def __init__(self, key):
+        # (actions, vpsimage, cost, history_limit) the state was fetched
+        # with, objects built with different ones aren't comparable
+        self.key = key
+
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def update(self, conn, response, identity_map=None, prepare=None):
+        """
+        :type response: list
+        :param response: raw instance dicts, as decoded from the API
+
+        :type prepare: callable
+        :param prepare: called as prepare(changed_dicts) before objects are
+                        built or patched, may modify the dicts in place
+
+        :rtype: RefreshResult
+        """
+
+        with self._lock:
+            state = self._state
+            fresh = {}
+            todo = []
+            unchanged = 0
+
+            for raw in response:
+                uuid = raw["uuid"]
+                known = state.get(uuid)
+                if known is not None and known[0] == raw:
+                    fresh[uuid] = known
+                    unchanged += 1
+                else:
+                    # keep a shallow copy, `prepare` may replace top-level values
+                    fresh[uuid] = (dict(raw), known[1] if known else None)
+                    todo.append(raw)
+
+            if prepare is not None and todo:
+                prepare(todo)
+
+            added = changed = 0
+            for raw in todo:
+                uuid = raw["uuid"]
+                previous, obj = fresh[uuid]
+                if obj is None:
+                    obj = Instance(conn, raw, identity_map)
+                    added += 1
+                else:
+                    obj._patch(raw, state[uuid][0], identity_map)
+                    changed += 1
+                fresh[uuid] = (previous, obj)
+
+            removed = sum(1 for uuid in state if uuid not in fresh)
+            self._state = fresh
+
+            return RefreshResult(
+                [fresh[raw["uuid"]][1] for raw in response],
+                added,
+                changed,
+                unchanged,
+                removed,
+            )
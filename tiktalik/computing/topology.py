@@ -0,0 +1,243 @@
+"""Module tiktalik.computing.topology"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import ipaddress
+from itertools import islice
+
+
+class NetworkTopology:
+    """
+    In-memory index of Networks, VPSNetInterfaces and Instances, built from
+    one list_networks() and one list_instances() call. All lookups are
+    dictionary accesses, no API calls are made after the index is built.
+
+    Use NetworkTopology.fetch(conn) to build it, and refresh(conn) to
+    rebuild it with current data.
+    """
+
+    def __init__(self, networks, instances):
+        self._build(networks, instances)
+
+    @classmethod
+    def fetch(cls, conn):
+        """
+        Build the topology with data fetched from the server.
+
+        :type conn: ComputingConnection
+        """
+
+        return cls(conn.list_networks(), conn.list_instances())
+
+    def refresh(self, conn):
+        """
+        Fetch current networks and instances and rebuild all indexes.
+        """
+
+        self._build(conn.list_networks(), conn.list_instances())
+
+    def _build(self, networks, instances):
+        self.networks = dict((n.uuid, n) for n in networks)
+        self.instances = dict((i.uuid, i) for i in instances)
+
+        self._by_cidr = {}
+        self._subnets = {}
+        for network in networks:
+            subnet = _subnet(network)
+            if subnet is not None:
+                self._subnets[network.uuid] = subnet
+                self._by_cidr[str(subnet)] = network
+
+        self._interfaces = {}
+        self._instance_of = {}
+        self._by_ip = {}
+        self._by_seq = {}
+        self._network_interfaces = {}
+        self._network_instances = {}
+        self._used = {}
+
+        for instance in instances:
+            for interface in instance.interfaces:
+                network = self.networks.get(interface.network.uuid)
+                if network is None:
+                    # a network not returned by list_networks, eg. a system one
+                    network = self.networks[interface.network.uuid] = interface.network
+                    subnet = _subnet(network)
+                    if subnet is not None:
+                        self._subnets[network.uuid] = subnet
+                        self._by_cidr.setdefault(str(subnet), network)
+                else:
+                    interface.network = network
+
+                self._interfaces[interface.uuid] = interface
+                self._instance_of[interface.uuid] = instance
+                self._by_seq[(instance.uuid, interface.seq)] = interface
+                if interface.ip:
+                    self._by_ip[interface.ip] = interface
+                    self._used.setdefault(network.uuid, set()).add(interface.ip)
+
+                self._network_interfaces.setdefault(network.uuid, []).append(
+                    interface
+                )
+                members = self._network_instances.setdefault(network.uuid, {})
+                members[instance.uuid] = instance
+
+    def network(self, uuid):
+        """
+        :rtype: Network
+        :return: Network with given UUID, or None
+        """
+
+        return self.networks.get(uuid)
+
+    def network_by_cidr(self, cidr):
+        """
+        :type cidr: string
+        :param cidr: network address in CIDR notation, eg. "10.1.2.0/24"
+
+        :rtype: Network
+        :return: Network with matching `net`, or None
+        """
+
+        try:
+            key = str(ipaddress.ip_network(cidr, strict=False))
+        except ValueError:
+            return None
+        return self._by_cidr.get(key)
+
+    def interfaces_in(self, network_uuid):
+        """
+        :rtype: list
+        :return: list of VPSNetInterface objects attached to the network
+        """
+
+        return list(self._network_interfaces.get(network_uuid, ()))
+
+    def instances_in(self, network_uuid):
+        """
+        :rtype: list
+        :return: list of Instance objects attached to the network
+        """
+
+        return list(self._network_instances.get(network_uuid, {}).values())
+
+    def networks_of(self, instance_uuid):
+        """
+        :rtype: list
+        :return: list of Network objects the instance is attached to
+        """
+
+        instance = self.instances.get(instance_uuid)
+        if instance is None:
+            return []
+        return [self.networks[i.network.uuid] for i in instance.interfaces]
+
+    def interface(self, uuid):
+        """
+        :rtype: VPSNetInterface
+        :return: interface with given UUID, or None
+        """
+
+        return self._interfaces.get(uuid)
+
+    def interface_by_ip(self, ip):
+        """
+        :rtype: VPSNetInterface
+        :return: interface that has the address `ip`, or None
+        """
+
+        return self._by_ip.get(ip)
+
+    def interface_by_seq(self, instance_uuid, seq):
+        """
+        :type seq: int
+        :param seq: interface sequence number, 0 for eth0, 1 for eth1 etc.
+
+        :rtype: VPSNetInterface
+        :return: the instance's interface with given `seq`, or None
+        """
+
+        return self._by_seq.get((instance_uuid, seq))
+
+    def instance_of(self, interface):
+        """
+        :type interface: VPSNetInterface or string
+        :param interface: interface or its UUID
+
+        :rtype: Instance
+        :return: Instance the interface is attached to, or None
+        """
+
+        return self._instance_of.get(getattr(interface, "uuid", interface))
+
+    def instance_by_ip(self, ip):
+        """
+        :rtype: Instance
+        :return: Instance that has the address `ip`, or None
+        """
+
+        interface = self._by_ip.get(ip)
+        return self._instance_of[interface.uuid] if interface else None
+
+    def used_addresses(self, network_uuid):
+        """
+        :rtype: set
+        :return: set of addresses (strings) assigned to interfaces in the network
+        """
+
+        return set(self._used.get(network_uuid, ()))
+
+    def free_addresses(self, network_uuid, limit=None, reserved=()):
+        """
+        Yield host addresses of the network that aren't assigned to any
+        interface. Addresses are generated lazily, so asking for a few free
+        addresses of a large network is cheap.
+
+        :type limit: int
+        :param limit: stop after this many addresses
+
+        :type reserved: iterable
+        :param reserved: additional addresses to skip, eg. a gateway
+
+        :rtype: iterator
+        :return: iterator of addresses (strings)
+        """
+
+        subnet = self._subnets.get(network_uuid)
+        if subnet is None:
+            return iter(())
+
+        used = self._used.get(network_uuid, set())
+        if reserved:
+            used = used.union(reserved)
+
+        free = (str(a) for a in subnet.hosts() if str(a) not in used)
+        return islice(free, limit)
+
+
+def _subnet(network):
+    net = getattr(network, "net", None)
+    if not net:
+        return None
+    try:
+        return ipaddress.ip_network(net, strict=False)
+    except ValueError:
+        return None
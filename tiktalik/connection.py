@@ -20,14 +20,24 @@
 
 # -*- coding: utf8 -*-
 import time
+import socket
+import threading
 import http.client
 import hmac
 import base64
 from urllib import parse
 import json
+import queue
 import string
 from hashlib import sha1, md5
-from .error import TiktalikAPIError
+from collections import OrderedDict
+from .error import TiktalikAPIError, TiktalikTimeoutError
+from .deadline import Deadline, current_deadline, earliest
+from .endpoints import EndpointSelector
+from . import tracing
+
+_READ_CHUNK = 64 * 1024
+_PREPARED_CACHE_SIZE = 256
 
 
 class TiktalikAuthConnection:
@@ -36,10 +46,37 @@ class TiktalikAuthConnection:
     """
 
     def __init__(
-        self, api_key, api_secret_key, host="tiktalik.com", port=443, use_ssl=True
+        self,
+        api_key,
+        api_secret_key,
+        host="tiktalik.com",
+        port=443,
+        use_ssl=True,
+        keep_alive=False,
+        pool_size=4,
+        timeout=20,
+        hedge=None,
+        circuit_breaker=None,
+        tracer=None,
+        endpoints=None,
+        scheduler=None,
+        sidecar=None,
+        recorder=None,
     ):
         self.api_key = api_key
         self.api_secret_key = api_secret_key
+
+        # tiktalik.endpoints.EndpointSelector, spreads requests over several
+        # endpoints of the API; `host` and `port` are then those of the first
+        # one. Requests are signed the same way for every endpoint, the host
+        # isn't part of the canonical string.
+        if endpoints is not None and not isinstance(endpoints, EndpointSelector):
+            endpoints = EndpointSelector(endpoints, default_port=port, use_ssl=use_ssl)
+        self.endpoints = endpoints
+        if endpoints is not None:
+            host = endpoints.endpoints[0].host
+            port = endpoints.endpoints[0].port
+
         self.host = host
         self.port = port
 
@@ -67,9 +104,49 @@ class TiktalikAuthConnection:
 
         self.use_ssl = use_ssl
 
-        self.timeout = 20
+        # socket timeout applied to every phase of a request; a deadline
+        # (see tiktalik.deadline) may shorten it further
+        self.timeout = timeout
         self.conn = None
 
+        # Idle HTTP connections kept open between requests when `keep_alive`
+        # is enabled. Only request() returns connections to the pool, as it
+        # is the only place where the response is known to be fully read.
+        self.keep_alive = keep_alive
+        self.pool_size = pool_size
+        self._pool = []
+        self._pool_lock = threading.Lock()
+
+        # tiktalik.hedging.HedgePolicy, enables hedging of GET requests
+        self.hedge = hedge
+
+        # tiktalik.circuitbreaker.CircuitBreaker, may be shared by connections
+        self.circuit_breaker = circuit_breaker
+
+        # tiktalik.tracing.Tracer, records timing of every call
+        self.tracer = tracer
+
+        # tiktalik.scheduler.RequestScheduler, orders requests by priority
+        # when more of them are made than it allows at once
+        self.scheduler = scheduler
+
+        # tiktalik.sidecar.SidecarClient, or the path of its socket: send
+        # request() calls through a local InventoryServer instead of HTTP
+        if isinstance(sidecar, str):
+            from .sidecar import SidecarClient
+
+            sidecar = SidecarClient(sidecar, timeout)
+        self.sidecar = sidecar
+
+        # tiktalik.traffic.TrafficRecorder, writes every request and its
+        # reply to a capture file that can be replayed later
+        self.recorder = recorder
+
+        # PreparedRequests reused by request() for GETs without a body
+        self._prepared_cache = OrderedDict()
+        self._prepared_lock = threading.Lock()
+        self._hmac = None
+
     def _encode_param(self, value):
         if isinstance(value, list):
             return list(map(self._encode_param, value))
@@ -78,7 +155,7 @@ class TiktalikAuthConnection:
 
         return value
 
-    def request(self, method, path, params=None, query_params=None):
+    def request(self, method, path, params=None, query_params=None, timeout=None):
         """
         Send a request over HTTP. The inheriting class must override self.base_url().
 
@@ -94,18 +171,69 @@ class TiktalikAuthConnection:
         :type query_params: dict
         :param query_params: a dictionary of parameters sent in request path
 
+        :type timeout: float or Deadline
+        :param timeout: total time limit for this call, in seconds. It's combined
+                        with the deadline set by `tiktalik.deadline.deadline()`,
+                        whichever expires first applies.
+
         :rtype: dict, string or None
         :return: a JSON dict if the server replied with "application/json".
                  Raw data otherwise. None, if the reply was empty.
         """
 
-        response = self.make_request(
+        if params is None and method == "GET":
+            prepared = self._cached_prepare(method, path, query_params)
+        else:
+            prepared = self.prepare(method, path, params, query_params)
+
+        return self.send(prepared, timeout)
+
+    def prepare(self, method, path, params=None, query_params=None):
+        """
+        Build a request that can be sent many times with send(). The path,
+        query string, body and its MD5 are computed once; sending only
+        refreshes the date and the signature.
+
+        Arguments are the same as for request().
+
+        :rtype: PreparedRequest
+        """
+
+        return self._prepare(
             method, self.base_url() + path, params=params, query_params=query_params
         )
 
-        data = response.read()
+    def send(self, prepared, timeout=None):
+        """
+        Send a PreparedRequest and return the decoded reply, like request().
+
+        :type prepared: PreparedRequest
+        :param prepared: request built by prepare()
+        """
+
+        if self.tracer is not None:
+            name = "%s %s" % (prepared.method, prepared.path)
+            with self.tracer.call(name, builds=False):
+                return self._send(prepared, timeout)
+        return self._send(prepared, timeout)
+
+    def _send(self, prepared, timeout):
+        deadline = self._deadline(timeout)
+        if self.sidecar is not None:
+            status, data = self.sidecar.send(prepared, deadline, self.api_key)
+            if status != 200:
+                raise TiktalikAPIError(status, data)
+            return data
+
+        response, data = self._perform(prepared, deadline)
+
         if response.getheader("Content-Type", "").startswith("application/json"):
-            data = json.loads(data)
+            trace = tracing.current_trace() if self.tracer is not None else None
+            if trace is not None:
+                with trace.phase("decode"):
+                    data = json.loads(data)
+            else:
+                data = json.loads(data)
 
         if response.status != 200:
             raise TiktalikAPIError(response.status, data)
@@ -122,15 +250,161 @@ class TiktalikAuthConnection:
         raise NotImplementedError()
 
     def make_request(
-        self, method, path, headers=None, body=None, params=None, query_params=None
+        self,
+        method,
+        path,
+        headers=None,
+        body=None,
+        params=None,
+        query_params=None,
+        timeout=None,
     ):
         """
         Sends request, returns httplib.HTTPResponse.
 
         If `params` is provided, it should be a dict that contains form parameters.
         Content-Type is forced to "application/x-www-form-urlencoded" in this case.
+
+        `timeout` limits the time until the response headers are received;
+        reading the response body is up to the caller.
         """
 
+        deadline = self._deadline(timeout)
+        prepared = self._prepare(method, path, headers, body, params, query_params)
+        if self.tracer is not None:
+            name = "%s %s" % (prepared.method, prepared.path)
+            with self.tracer.call(name, builds=False):
+                return self._perform(prepared, deadline, False)[0]
+        return self._perform(prepared, deadline, False)[0]
+
+    def close(self):
+        """
+        Close all idle connections kept open by `keep_alive`.
+        """
+
+        with self._pool_lock:
+            pool, self._pool = self._pool, []
+
+        for conn in pool:
+            conn.close()
+
+    def _cached_prepare(self, method, path, query_params):
+        # True and 1 are equal, but encoded differently
+        items = ((k, type(v), v) for (k, v) in (query_params or {}).items())
+        key = (method, path, tuple(sorted(items)))
+        try:
+            hash(key)
+        except TypeError:
+            # list values
+            return self.prepare(method, path, query_params=query_params)
+
+        with self._prepared_lock:
+            prepared = self._prepared_cache.get(key)
+            if prepared is not None:
+                self._prepared_cache.move_to_end(key)
+                return prepared
+
+        prepared = self.prepare(method, path, query_params=query_params)
+        with self._prepared_lock:
+            self._prepared_cache[key] = prepared
+            if len(self._prepared_cache) > _PREPARED_CACHE_SIZE:
+                self._prepared_cache.popitem(last=False)
+        return prepared
+
+    def _perform(self, prepared, deadline, read=True):
+        """
+        Send a prepared request, passing it through the scheduler and the
+        circuit breaker.
+
+        :return: tuple (HTTPResponse, body); body is None when `read` is False
+        """
+
+        if self.scheduler is None:
+            return self._perform_now(prepared, deadline, read)
+
+        trace = tracing.current_trace() if self.tracer is not None else None
+        start = time.monotonic()
+        with self.scheduler.slot(deadline):
+            if trace is not None:
+                trace.add("queue", time.monotonic() - start)
+            return self._perform_now(prepared, deadline, read)
+
+    def _perform_now(self, prepared, deadline, read):
+        if deadline is not None:
+            # nothing would be sent, and it's not the server's fault
+            deadline.check("connect")
+
+        breaker = self.circuit_breaker
+        key = self._circuit_key(prepared.method) if breaker is not None else None
+        if key is not None:
+            breaker.before(key)
+
+        trace = tracing.current_trace() if self.tracer is not None else None
+        recorder = self.recorder
+        if recorder is not None:
+            began = time.monotonic()
+            headers_at = None
+
+        try:
+            conn, sock, response = self._transmit(prepared, deadline, trace=trace)
+            if recorder is not None:
+                headers_at = time.monotonic()
+
+            data = None
+            if read:
+                start = time.monotonic()
+                data = self._read(response, sock, deadline)
+                self._release(conn, response)
+                if trace is not None:
+                    trace.add("read", time.monotonic() - start)
+        except Exception as e:
+            # network errors, timeouts and protocol errors
+            if key is not None:
+                if _out_of_budget(e, deadline):
+                    breaker.release(key)
+                else:
+                    breaker.record(key, False)
+            if recorder is not None:
+                recorder.record(
+                    prepared, began, headers_at, time.monotonic(), None, error=e
+                )
+            raise
+
+        if recorder is not None:
+            recorder.record(
+                prepared, began, headers_at, time.monotonic(), response.status, data
+            )
+
+        if key is not None:
+            breaker.record(key, response.status < 500)
+        if trace is not None:
+            trace.requests += 1
+            trace.status = response.status
+
+        return response, data
+
+    def _circuit_key(self, method):
+        family = self.base_url().rsplit("/", 1)[-1]
+        return (self.host, family, "read" if method == "GET" else "write")
+
+    def _deadline(self, timeout):
+        """
+        Return the Deadline applicable to a call: the earlier one of `timeout`
+        and the deadline active in the current context.
+        """
+
+        if timeout is not None and not isinstance(timeout, Deadline):
+            timeout = Deadline(timeout)
+        return earliest(timeout, current_deadline())
+
+    def _phase_timeout(self, deadline, phase):
+        if deadline is None:
+            return self.timeout
+        return min(self.timeout, deadline.check(phase))
+
+    def _prepare(
+        self, method, path, headers=None, body=None, params=None, query_params=None
+    ):
         if params and body:
             raise ValueError("Both `body` and `params` can't be provided.")
 
@@ -162,17 +436,260 @@ class TiktalikAuthConnection:
             m = md5(body.encode("utf-8"))
             headers["content-md5"] = m.hexdigest()
 
-        conn = self.conn_cls(self.host, self.port, timeout=self.timeout)
-        headers = self._add_auth_header(method, path, headers or {})
-        # conn.set_debuglevel(3)
-        conn.request(method, path, body, headers)
+        return PreparedRequest(method, path, body, headers)
+
+    def _transmit(self, prepared, deadline=None, track=None, trace=None):
+        """
+        Sign and send a prepared request, wait for the response headers.
+
+        Connections used by this attempt are appended to `track`, if given,
+        so that the attempt can be cancelled from another thread. Timing of
+        each phase is added to `trace`, if given.
+
+        :return: tuple (connection, socket, HTTPResponse)
+        """
+
+        if self.hedge is not None and prepared.method == "GET" and track is None:
+            if trace is None:
+                return self._transmit_hedged(prepared, deadline)
+            # attempts run in their own threads, only the total wait is known
+            with trace.phase("ttfb"):
+                return self._transmit_hedged(prepared, deadline)
+
+        headers = self._sign_prepared(prepared)
+        if self.endpoints is None:
+            return self._transmit_to(None, prepared, headers, deadline, track, trace)
+        return self._transmit_failover(prepared, headers, deadline, track, trace)
+
+    def _transmit_failover(self, prepared, headers, deadline, track, trace):
+        """
+        Send the request to the endpoint chosen by the EndpointSelector. When
+        the endpoint fails and the request is safe to repeat, send it to the
+        next one, within the same deadline.
+        """
+
+        selector = self.endpoints
+        tried = []
+        while True:
+            endpoint = selector.select(exclude=tried)
+            start = time.monotonic()
+            try:
+                result = self._transmit_to(
+                    endpoint, prepared, headers, deadline, track, trace
+                )
+            except Exception as e:
+                if getattr(track, "cancelled", False) or _out_of_budget(e, deadline):
+                    # the endpoint isn't to blame, and the request is over
+                    selector.release(endpoint)
+                    raise
+                selector.record(endpoint, None, False)
+                tried.append(endpoint)
+                if (
+                    len(tried) == len(selector)
+                    or not _can_failover(prepared.method, e)
+                    or (deadline is not None and deadline.expired())
+                ):
+                    raise
+                continue
+
+            selector.record(endpoint, time.monotonic() - start, result[2].status < 500)
+            return result
+
+    def _transmit_to(self, endpoint, prepared, headers, deadline, track, trace):
+        method, path, body = prepared.method, prepared.path, prepared.body
+
+        conn, reused = self._acquire(endpoint)
+        if track is not None:
+            track.append(conn)
+        try:
+            return self._exchange(conn, method, path, body, headers, deadline, trace)
+        except (
+            http.client.RemoteDisconnected,
+            ConnectionResetError,
+            BrokenPipeError,
+        ) as e:
+            conn.close()
+            # A broken pipe means the request couldn't be written. A reset or
+            # disconnect may also come after the server processed it, so
+            # only GETs are repeated then.
+            if not reused or (method != "GET" and not isinstance(e, BrokenPipeError)):
+                raise
+
+            # The server dropped an idle keep-alive connection, send the
+            # request once more on a fresh one, within the same deadline.
+            conn = self._new_connection(endpoint)
+            if track is not None:
+                track.append(conn)
+            try:
+                return self._exchange(
+                    conn, method, path, body, headers, deadline, trace
+                )
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+    def _transmit_hedged(self, prepared, deadline):
+        """
+        Send the request, and if it's not answered within the delay chosen by
+        the HedgePolicy, send it again on another connection. The first
+        response wins, the other attempt is cancelled.
+        """
+
+        policy = self.hedge
+        policy.started()
+        results = queue.Queue()
+
+        primary = _Attempt(self, prepared, deadline, results)
+        primary.start()
+        attempts = [primary]
 
-        response = conn.getresponse()
-        return response
+        delay = policy.delay()
+        if deadline is not None and deadline.remaining() <= delay:
+            # a hedge couldn't be sent before the deadline, wait for the primary
+            delay = None
+
+        try:
+            winner, result, error = results.get(timeout=delay)
+        except queue.Empty:
+            winner = None
+            if policy.acquire():
+                hedge = _Attempt(self, prepared, deadline, results)
+                hedge.start()
+                attempts.append(hedge)
+
+        pending = len(attempts) - (winner is not None)
+        first_error = None
+        while True:
+            if winner is None:
+                winner, result, error = results.get()
+                pending -= 1
+
+            if error is None:
+                break
+
+            # a failed attempt is only fatal when there is nothing left to wait for
+            first_error = first_error or error
+            if not pending:
+                raise first_error
+            winner = None
+
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel(results)
+
+        if len(attempts) > 1:
+            policy.finished(hedge_won=winner is not primary)
+        policy.record(winner.latency)
+        return result
+
+    def _exchange(self, conn, method, path, body, headers, deadline, trace=None):
+        phase = "connect"
+        try:
+            if conn.sock is None:
+                conn.timeout = self._phase_timeout(deadline, phase)
+                if trace is not None:
+                    tracing.connect(conn, trace)
+                else:
+                    conn.connect()
+
+            sock = conn.sock
+
+            phase = "send"
+            sock.settimeout(self._phase_timeout(deadline, phase))
+            start = time.monotonic()
+            # conn.set_debuglevel(3)
+            conn.request(method, path, body, headers)
+
+            phase = "first_byte"
+            sock.settimeout(self._phase_timeout(deadline, phase))
+            sent = time.monotonic()
+            response = conn.getresponse()
+            if trace is not None:
+                trace.add("send", sent - start)
+                trace.add("ttfb", time.monotonic() - sent)
+        except socket.timeout:
+            raise TiktalikTimeoutError(phase, self._phase_limit(deadline))
+
+        return conn, sock, response
+
+    def _read(self, response, sock, deadline):
+        """
+        Read the whole response body. With a deadline, the socket timeout is
+        shortened before every chunk, so the total read time is bounded too.
+        """
+
+        try:
+            if deadline is None:
+                return response.read()
+
+            chunks = []
+            while True:
+                sock.settimeout(self._phase_timeout(deadline, "read"))
+                chunk = response.read(_READ_CHUNK)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b"".join(chunks)
+        except socket.timeout:
+            raise TiktalikTimeoutError("read", self._phase_limit(deadline))
+
+    def _phase_limit(self, deadline):
+        if deadline is None or deadline.timeout > self.timeout:
+            return self.timeout
+        return deadline.timeout
+
+    def _new_connection(self, endpoint=None):
+        if endpoint is None:
+            return self.conn_cls(self.host, self.port, timeout=self.timeout)
+        return self.conn_cls(endpoint.host, endpoint.port, timeout=self.timeout)
+
+    def _acquire(self, endpoint=None):
+        """
+        Return a tuple (connection, reused), taking an idle connection to
+        `endpoint` from the pool if one is available.
+        """
+
+        if self.keep_alive:
+            with self._pool_lock:
+                if endpoint is None:
+                    if self._pool:
+                        return self._pool.pop(), True
+                else:
+                    for i in range(len(self._pool) - 1, -1, -1):
+                        conn = self._pool[i]
+                        if conn.host == endpoint.host and conn.port == endpoint.port:
+                            del self._pool[i]
+                            return conn, True
+
+        return self._new_connection(endpoint), False
+
+    def _release(self, conn, response):
+        if self.keep_alive and not response.will_close and response.isclosed():
+            with self._pool_lock:
+                if len(self._pool) < self.pool_size:
+                    self._pool.append(conn)
+                    return
+
+        conn.close()
+
+    def _sign_prepared(self, prepared):
+        """
+        Return a copy of the request headers with a fresh date and signature.
+        """
+
+        headers = dict(prepared.headers)
+        date = headers.get("date") or _http_date()
+        headers["date"] = date
+        S = prepared.canonical_prefix + date + prepared.canonical_suffix
+        headers["Authorization"] = "TKAuth %s:%s" % (self.api_key, self._sign_string(S))
+        return headers
 
     def _add_auth_header(self, method, path, headers):
         if "date" not in headers:
-            headers["date"] = time.strftime("%a, %d %b %Y %X GMT", time.gmtime())
+            headers["date"] = _http_date()
 
         S = self._canonical_string(method, path, headers)
         headers["Authorization"] = "TKAuth %s:%s" % (self.api_key, self._sign_string(S))
@@ -192,7 +709,160 @@ class TiktalikAuthConnection:
         return S
 
     def _sign_string(self, S):
-        digest = base64.b64encode(
-            hmac.new(self.api_secret_key, S.encode("utf-8"), sha1).digest()
-        )
-        return digest.decode("utf-8")
+        # copying a keyed HMAC is cheaper than setting up the key every time
+        if self._hmac is None:
+            self._hmac = hmac.new(self.api_secret_key, digestmod=sha1)
+        h = self._hmac.copy()
+        h.update(S.encode("utf-8"))
+        return base64.b64encode(h.digest()).decode("utf-8")
+
+
+def _out_of_budget(error, deadline):
+    """
+    Whether `error` is a timeout caused by the caller's deadline running out,
+    rather than by the server exceeding the connection's own timeout.
+    """
+
+    return (
+        isinstance(error, TiktalikTimeoutError)
+        and deadline is not None
+        and deadline.expired()
+    )
+
+
+def _can_failover(method, error):
+    """
+    Whether a request that failed with `error` may be sent to another
+    endpoint: GETs always, other requests only if they surely weren't sent.
+    """
+
+    if method == "GET":
+        return isinstance(error, (OSError, http.client.HTTPException))
+    if isinstance(error, TiktalikTimeoutError):
+        return error.phase == "connect"
+    return isinstance(error, (ConnectionRefusedError, socket.gaierror))
+
+
+class PreparedRequest:
+    """
+    A request with everything but the date and signature computed in advance.
+    Built by TiktalikAuthConnection.prepare(), sent by .send(). Don't modify
+    its attributes once created.
+
+    Attributes:
+        method: string
+        path: string - quoted path, including the query string
+        body: string or None
+        headers: dict - headers sent with every request, without date and
+                 signature
+    """
+
+    def __init__(self, method, path, body, headers):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers
+
+        # the canonical string is "method, md5, type, date, path", joined
+        # with newlines; only the date changes between sends
+        self.canonical_prefix = "\n".join(
+            (method, headers.get("content-md5", ""), headers.get("content-type", ""))
+        ) + "\n"
+        self.canonical_suffix = "\n" + path
+
+    def __repr__(self):
+        return "<PreparedRequest: %s %s>" % (self.method, self.path)
+
+
+_date_cache = (None, None)
+
+
+def _http_date():
+    """
+    Current date in the format used by the Date header. Formatted at most
+    once per second.
+    """
+
+    global _date_cache
+    now = int(time.time())
+    second, date = _date_cache
+    if second != now:
+        date = time.strftime("%a, %d %b %Y %X GMT", time.gmtime(now))
+        _date_cache = (now, date)
+    return date
+
+
+class _Track(list):
+    """
+    Connections used by an _Attempt. `cancelled` is set before they're shut
+    down, so the errors it causes aren't taken for endpoint failures.
+    """
+
+    cancelled = False
+
+
+class _Attempt(threading.Thread):
+    """
+    A single attempt of a hedged request, performed in its own thread.
+    Puts a tuple (attempt, result, error) to `results` when done.
+    """
+
+    def __init__(self, owner, prepared, deadline, results):
+        super(_Attempt, self).__init__()
+        self.daemon = True
+        self.owner = owner
+        self.args_ = (prepared, deadline)
+        self.results = results
+        self.conns = _Track()
+        self.latency = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            result = self.owner._transmit(*self.args_, track=self.conns)
+            error = None
+        except Exception as e:
+            result = None
+            error = e
+        self.latency = time.monotonic() - start
+
+        with self.lock:
+            if self.cancelled:
+                if result is not None:
+                    result[0].close()
+                return
+            self.results.put((self, result, error))
+
+    def cancel(self, results):
+        """
+        Abort the attempt. Its connection is shut down, so a blocked socket
+        operation returns immediately; a response that was already received
+        is discarded.
+        """
+
+        with self.lock:
+            self.cancelled = True
+            self.conns.cancelled = True
+            for conn in self.conns:
+                if conn.sock is not None:
+                    try:
+                        conn.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+        # collect the result this attempt could have produced before cancel()
+        stash = []
+        while True:
+            try:
+                item = results.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] is self:
+                if item[1] is not None:
+                    item[1][0].close()
+            else:
+                stash.append(item)
+        for item in stash:
+            results.put(item)
@@ -0,0 +1,124 @@
+"""Module tiktalik.deadline"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import time
+import threading
+from contextlib import contextmanager
+
+from .error import TiktalikTimeoutError
+
+__all__ = ["Deadline", "deadline", "current_deadline"]
+
+
+class Deadline:
+    """
+    A point in time by which an operation has to complete. Shared by every
+    request made while it's active, so retries and multi-request operations
+    consume the same budget.
+
+    Attributes:
+        timeout: float - the whole budget, in seconds
+        expires: float - expiration time, as returned by time.monotonic()
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+
+    def remaining(self):
+        """
+        :rtype: float
+        :return: seconds left, negative if the deadline has passed
+        """
+
+        return self.expires - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, phase):
+        """
+        Return the remaining budget, or raise TiktalikTimeoutError for `phase`
+        if nothing is left.
+        """
+
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise TiktalikTimeoutError(phase, self.timeout)
+        return remaining
+
+    def __repr__(self):
+        return "<Deadline: %.3fs of %.3fs left>" % (self.remaining(), self.timeout)
+
+
+_local = threading.local()
+
+
+def current_deadline():
+    """
+    :rtype: Deadline
+    :return: the innermost deadline active in this thread, or None
+    """
+
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def earliest(*deadlines):
+    """
+    Return the deadline that expires first, ignoring None values.
+    """
+
+    deadlines = [d for d in deadlines if d is not None]
+    if not deadlines:
+        return None
+    return min(deadlines, key=lambda d: d.expires)
+
+
+@contextmanager
+def deadline(timeout):
+    """
+    Limit the total time of all API calls made in this thread within the
+    `with` block. Nested blocks can only shorten the budget, never extend it.
+
+        with deadline(2.5):
+            instance = conn.get_instance(uuid)
+            interfaces = conn.list_instance_interfaces(uuid)
+
+    :type timeout: float or Deadline
+    :param timeout: budget in seconds, or an existing Deadline to propagate
+    """
+
+    if not isinstance(timeout, Deadline):
+        timeout = Deadline(timeout)
+
+    active = earliest(timeout, current_deadline())
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    stack.append(active)
+    try:
+        yield active
+    finally:
+        stack.pop()
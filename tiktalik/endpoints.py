@@ -0,0 +1,304 @@
+"""Module tiktalik.endpoints"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import time
+import random
+import threading
+import http.client
+
+__all__ = ["Endpoint", "EndpointSelector"]
+
+
+class Endpoint:
+    """
+    An API endpoint and what is known about its health.
+
+    Attributes:
+        host: string
+        port: int
+        latency: float - EWMA of the time to the response headers, in
+                 seconds; None until the first response
+        failures: int - consecutive failed requests
+        down_until: float - time.monotonic() until which the endpoint is
+                    not used, None when it's healthy
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.latency = None
+        self.failures = 0
+        self.ejections = 0
+        self.down_until = None
+        self.probing = False
+        self.readmitted_at = None
+
+    def __str__(self):
+        return "%s:%s" % (self.host, self.port)
+
+    def __repr__(self):
+        return "<Endpoint: %s>" % self
+
+    def as_dict(self):
+        return dict(
+            host=self.host,
+            port=self.port,
+            latency=self.latency,
+            failures=self.failures,
+            down=self.down_until is not None,
+        )
+
+
+class EndpointSelector:
+    """
+    Chooses the API endpoint for each request. Pass an instance, or a list of
+    endpoints, as `endpoints` to a connection. One EndpointSelector may be
+    shared by many connections.
+
+    Latency is tracked passively: every request updates an EWMA (weight
+    `alpha`) of the time to the response headers of its endpoint. A small
+    fraction of requests (`explore`) goes to another healthy endpoint
+    to keep its latency up to date. Endpoints not measured yet are
+    tried first.
+
+    With `probe_interval` set, latency is also tracked actively: every
+    `probe_interval` seconds a background thread sends an unauthenticated
+    HEAD request for `probe_path` to each healthy endpoint, over a kept-alive
+    connection, and adds its time to the response headers to the EWMA.
+    Endpoints that get little traffic are then measured without sending
+    them real requests. Probes don't affect the health of endpoints.
+
+    After `max_failures` consecutive network errors, timeouts or HTTP 5xx
+    responses an endpoint is taken out for `cooldown` seconds, doubled with
+    every subsequent ejection up to `max_cooldown`. Then a single request
+    probes it; on success the endpoint is re-admitted gradually, receiving
+    a share of the traffic it would get as the fastest endpoint that grows
+    linearly over `ramp` seconds.
+
+    :type endpoints: list
+    :param endpoints: "host", "host:port" strings or (host, port) tuples
+    """
+
+    def __init__(
+        self,
+        endpoints,
+        default_port=443,
+        alpha=0.3,
+        explore=0.02,
+        max_failures=2,
+        cooldown=5.0,
+        max_cooldown=120.0,
+        ramp=30.0,
+        probe_interval=None,
+        probe_path="/",
+        use_ssl=True,
+        probe_timeout=2.0,
+    ):
+        self.endpoints = [self._parse(e, default_port) for e in endpoints]
+        if not self.endpoints:
+            raise ValueError("At least one endpoint is required")
+
+        self.alpha = alpha
+        self.explore = explore
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.ramp = ramp
+        self._lock = threading.Lock()
+
+        self.probe_interval = probe_interval
+        self.probe_path = probe_path
+        self.probe_timeout = probe_timeout
+        if use_ssl:
+            self._probe_cls = http.client.HTTPSConnection
+        else:
+            self._probe_cls = http.client.HTTPConnection
+        self._probe_conns = {}
+        self._stopped = threading.Event()
+        if probe_interval:
+            self._prober = threading.Thread(target=self._probe_loop)
+            self._prober.daemon = True
+            self._prober.start()
+
+    @staticmethod
+    def _parse(endpoint, default_port):
+        if isinstance(endpoint, Endpoint):
+            return endpoint
+        if isinstance(endpoint, (tuple, list)):
+            return Endpoint(endpoint[0], int(endpoint[1]))
+        host, sep, port = endpoint.rpartition(":")
+        if sep and port.isdigit() and not host.endswith(":"):
+            return Endpoint(host.strip("[]"), int(port))
+        return Endpoint(endpoint.strip("[]"), default_port)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def select(self, exclude=()):
+        """
+        :type exclude: list
+        :param exclude: endpoints that already failed this request
+
+        :rtype: Endpoint
+        :return: endpoint to send the next request to, None when all of
+                 them are excluded
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            healthy = []
+            down = []
+            for e in self.endpoints:
+                if e in exclude:
+                    continue
+                if e.down_until is None:
+                    healthy.append(e)
+                elif e.down_until <= now and not e.probing:
+                    # cooldown over, let one request through to check it
+                    e.probing = True
+                    return e
+                else:
+                    down.append(e)
+
+            if not healthy:
+                # everything is down: try the one that is due first rather
+                # than failing without sending anything
+                if not down:
+                    return None
+                return min(down, key=lambda e: e.down_until)
+
+            if len(healthy) > 1 and random.random() < self.explore:
+                return random.choice(healthy)
+
+            healthy.sort(key=lambda e: -1 if e.latency is None else e.latency)
+            for e in healthy:
+                if e.readmitted_at is not None:
+                    share = (now - e.readmitted_at) / self.ramp if self.ramp else 1
+                    if share >= 1:
+                        e.readmitted_at = None
+                    elif random.random() >= share:
+                        continue
+                return e
+            return healthy[-1]
+
+    def record(self, endpoint, latency, success):
+        """
+        Record the outcome of a request sent to `endpoint`.
+
+        :type latency: float
+        :param latency: time to the response headers, None if there was no
+                        response
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            if latency is not None:
+                if endpoint.latency is None or endpoint.probing:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += self.alpha * (latency - endpoint.latency)
+
+            if success:
+                endpoint.failures = 0
+                if endpoint.down_until is not None:
+                    endpoint.down_until = None
+                    endpoint.ejections = 0
+                    endpoint.readmitted_at = now
+                endpoint.probing = False
+                return
+
+            endpoint.failures += 1
+            if endpoint.probing or (
+                endpoint.down_until is None and endpoint.failures >= self.max_failures
+            ):
+                cooldown = self.cooldown * 2 ** endpoint.ejections
+                endpoint.down_until = now + min(cooldown, self.max_cooldown)
+                endpoint.ejections += 1
+                endpoint.readmitted_at = None
+            endpoint.probing = False
+
+    def release(self, endpoint):
+        """
+        Called instead of record() when a request sent to `endpoint` ended
+        without telling anything about it, eg. because it was cancelled.
+        """
+
+        with self._lock:
+            endpoint.probing = False
+
+    def close(self):
+        """
+        Stop active probing.
+        """
+
+        self._stopped.set()
+
+    def _probe_loop(self):
+        while not self._stopped.wait(self.probe_interval):
+            for endpoint in self.endpoints:
+                if endpoint.down_until is None:
+                    self._probe(endpoint)
+        for conn in self._probe_conns.values():
+            conn.close()
+
+    def _probe(self, endpoint):
+        conn = self._probe_conns.get(endpoint)
+        if conn is None:
+            conn = self._probe_conns[endpoint] = self._probe_cls(
+                endpoint.host, endpoint.port, timeout=self.probe_timeout
+            )
+            # not timed, requests are measured on connections already open
+            try:
+                conn.connect()
+            except (OSError, http.client.HTTPException):
+                del self._probe_conns[endpoint]
+                conn.close()
+                return
+
+        try:
+            start = time.monotonic()
+            conn.request("HEAD", self.probe_path)
+            response = conn.getresponse()
+            latency = time.monotonic() - start
+            response.read()
+        except (OSError, http.client.HTTPException):
+            del self._probe_conns[endpoint]
+            conn.close()
+            return
+
+        if response.will_close:
+            del self._probe_conns[endpoint]
+            conn.close()
+        with self._lock:
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += self.alpha * (latency - endpoint.latency)
+
+    def stats(self):
+        """
+        :rtype: list
+        :return: list of dicts describing the endpoints, see Endpoint.as_dict()
+        """
+
+        with self._lock:
+            return [e.as_dict() for e in self.endpoints]
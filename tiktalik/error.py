@@ -40,3 +40,51 @@ class TiktalikAPIError(Exception):
 
     def __str__(self):
         return "TiktalikAPIError: %s %s" % (self.http_status, self.description)
+
+
+class TiktalikTimeoutError(TiktalikAPIError):
+    """
+    Raised when an API call runs out of time.
+
+    Attributes:
+        phase: string - phase of the request that exceeded the time limit,
+               one of "queue", "connect", "send", "first_byte", "read"; or
+               the state BackupOrchestrator waited for: "stop", "backup",
+               "start"
+        timeout: float - the time limit (in seconds) that was exceeded
+    """
+
+    def __init__(self, phase, timeout):
+        super(TiktalikTimeoutError, self).__init__(None)
+        self.args = (phase, timeout)
+        self.phase = phase
+        self.timeout = timeout
+
+    def __str__(self):
+        return "TiktalikTimeoutError: %s timed out (limit %.3fs)" % (
+            self.phase,
+            self.timeout,
+        )
+
+
+class TiktalikCircuitOpenError(TiktalikAPIError):
+    """
+    Raised without contacting the server when a CircuitBreaker considers
+    the API endpoint degraded.
+
+    Attributes:
+        key: tuple - (host, family, kind) of the open circuit
+        retry_after: float - seconds until the circuit lets a probe through
+    """
+
+    def __init__(self, key, retry_after):
+        super(TiktalikCircuitOpenError, self).__init__(None)
+        self.args = (key, retry_after)
+        self.key = key
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return "TiktalikCircuitOpenError: circuit %s is open, retry in %.1fs" % (
+            "/".join(str(k) for k in self.key),
+            self.retry_after,
+        )
@@ -0,0 +1,100 @@
+"""Module tiktalik.filters"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+__all__ = ["prefix", "compile_filter"]
+
+
+class prefix:
+    """
+    Filter value matching strings that start with `value`:
+
+        conn.list_instances(filter={"hostname": prefix("web-")})
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, value):
+        return isinstance(value, str) and value.startswith(self.value)
+
+    def __repr__(self):
+        return "prefix(%r)" % self.value
+
+
+_MISSING = object()
+
+
+def _lookup(raw, path):
+    for key in path:
+        if not isinstance(raw, dict):
+            return _MISSING
+        raw = raw.get(key, _MISSING)
+        if raw is _MISSING:
+            return raw
+    return raw
+
+
+def compile_filter(spec, server_fields=()):
+    """
+    Turn a `filter` argument of the list_* methods into a function matching
+    raw (decoded JSON) dicts, and query parameters for the server.
+
+    `spec` is either a callable, called with each raw dict, or a dict
+    mapping field names to expected values. Names may use dots for nested
+    fields ("vpsimage.name"). Values are compared for equality, unless they
+    are callable - then they're called with the field value, see prefix().
+    A missing field never matches.
+
+    :type server_fields: iterable
+    :param server_fields: fields the server can filter on by equality; such
+                          conditions are also returned as query parameters
+
+    :rtype: tuple
+    :return: (match, query_params); match is None when there's nothing to
+             check locally
+    """
+
+    if spec is None:
+        return None, {}
+    if callable(spec):
+        return spec, {}
+
+    query = {}
+    checks = []
+    for name, expected in spec.items():
+        if name in server_fields and not callable(expected):
+            query[name] = expected
+        checks.append((tuple(name.split(".")), expected))
+
+    def match(raw):
+        for path, expected in checks:
+            value = _lookup(raw, path)
+            if value is _MISSING:
+                return False
+            if callable(expected):
+                if not expected(value):
+                    return False
+            elif value != expected:
+                return False
+        return True
+
+    return match, query
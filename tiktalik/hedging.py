@@ -0,0 +1,176 @@
+"""Module tiktalik.hedging"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import threading
+from collections import deque
+
+__all__ = ["HedgePolicy", "HedgeStats"]
+
+
+class HedgeStats:
+    """
+    Counters describing how hedging performed.
+
+    Attributes:
+        requests: int - hedge-eligible requests sent
+        hedged: int - requests for which a second attempt was sent
+        hedge_wins: int - hedged requests answered first by the second attempt
+        primary_wins: int - hedged requests answered first by the original attempt
+        budget_denied: int - requests that were slow but couldn't be hedged
+                       because the hedging budget was exhausted
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.budget_denied = 0
+
+    def helped_ratio(self):
+        """
+        :rtype: float
+        :return: fraction of hedged requests where the hedge answered first
+        """
+
+        if not self.hedged:
+            return 0.0
+        return float(self.hedge_wins) / self.hedged
+
+    def as_dict(self):
+        return dict(vars(self), helped_ratio=self.helped_ratio())
+
+    def __str__(self):
+        return "<HedgeStats: requests=%d, hedged=%d, hedge_wins=%d, denied=%d>" % (
+            self.requests,
+            self.hedged,
+            self.hedge_wins,
+            self.budget_denied,
+        )
+
+
+class HedgePolicy:
+    """
+    Decides when a GET request should be hedged, ie. sent for the second time
+    on another connection while the first attempt is still pending.
+
+    The hedge delay follows the observed latency: it's the `percentile`
+    of the last `window` response times (time to response headers), clamped
+    to [min_delay, max_delay]. Until `min_samples` are collected,
+    `initial_delay` is used.
+
+    The number of hedges is capped with a token bucket: every request adds
+    `budget` tokens, every hedge takes one. With the default budget of 0.05
+    at most about 5% of requests are sent twice. `burst` limits how many
+    tokens may be accumulated.
+
+    Pass an instance as `hedge` to a connection to enable hedging:
+
+        conn = ComputingConnection(key, secret, hedge=HedgePolicy())
+        ...
+        print(conn.hedge.stats)
+    """
+
+    def __init__(
+        self,
+        percentile=95,
+        initial_delay=0.5,
+        min_delay=0.01,
+        max_delay=5.0,
+        budget=0.05,
+        burst=10,
+        window=256,
+        min_samples=20,
+    ):
+        if not 0 < percentile <= 100:
+            raise ValueError("percentile must be in (0, 100]")
+
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.burst = burst
+        self.min_samples = min_samples
+
+        self.stats = HedgeStats()
+        self._samples = deque(maxlen=window)
+        self._tokens = float(burst)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """
+        :rtype: float
+        :return: seconds to wait for the first attempt before hedging
+        """
+
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return self.initial_delay
+            samples = sorted(self._samples)
+
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100.0))
+        return min(self.max_delay, max(self.min_delay, samples[index]))
+
+    def record(self, latency):
+        """
+        Record the time it took to receive response headers.
+        """
+
+        with self._lock:
+            self._samples.append(latency)
+
+    def started(self):
+        """
+        Account a new hedge-eligible request.
+        """
+
+        with self._lock:
+            self.stats.requests += 1
+            self._tokens = min(self.burst, self._tokens + self.budget)
+
+    def acquire(self):
+        """
+        Try to take a token for a hedge.
+
+        :rtype: boolean
+        :return: True if the request may be hedged
+        """
+
+        with self._lock:
+            if self._tokens < 1:
+                self.stats.budget_denied += 1
+                return False
+            self._tokens -= 1
+            self.stats.hedged += 1
+            return True
+
+    def finished(self, hedge_won):
+        """
+        Account the outcome of a hedged request.
+        """
+
+        with self._lock:
+            if hedge_won:
+                self.stats.hedge_wins += 1
+            else:
+                self.stats.primary_wins += 1
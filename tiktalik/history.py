@@ -0,0 +1,181 @@
+"""Module tiktalik.history"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import heapq
+import threading
+from collections import deque
+
+__all__ = ["ActionHistory", "HistoryTracker"]
+
+
+def action_key(action):
+    """
+    Ordering key of a raw action dict: its start time, then its UUID.
+    Operations have "start_time", load balancer actions a "time".
+    """
+
+    time = action.get("start_time") or action.get("time") or action.get("date")
+    return (time or "", action.get("uuid") or "")
+
+
+class ActionHistory(deque):
+    """
+    The newest actions of an object, oldest first, kept in a ring buffer of
+    `maxlen` entries. Iterating over it (or indexing) only touches these
+    entries; older actions are available through older() and iter_all(),
+    which fetch the complete history from the server on first use.
+    """
+
+    def __init__(self, limit, build, fetch_all=None):
+        super(ActionHistory, self).__init__(maxlen=limit)
+        self.build = build
+        self.fetch_all = fetch_all
+
+        # key of the newest action seen so far
+        self.cursor = None
+        # unfinished actions, updated in place by the next refresh
+        self.running = {}
+        self._older = None
+
+    def __reduce__(self):
+        # builders are bound to a connection, a pickled history is a plain list
+        return (list, (list(self),))
+
+    def older(self):
+        """
+        Yield actions older than those kept in the buffer, newest first.
+        The complete history is fetched with one API call on first use,
+        objects are built as they are iterated and cached.
+        """
+
+        if self._older is None:
+            raw = self.fetch_all() if self.fetch_all is not None else []
+            oldest = action_key(vars(self[0])) if len(self) else None
+            older = [a for a in raw if oldest is None or action_key(a) < oldest]
+            older.sort(key=action_key, reverse=True)
+            self._older = (older, [])
+
+        raw, built = self._older
+        for i, action in enumerate(raw):
+            if i == len(built):
+                built.append(self.build(action))
+            yield built[i]
+
+    def iter_all(self):
+        """
+        Yield all actions, newest first: the buffered ones, then older().
+        """
+
+        for action in reversed(self):
+            yield action
+        for action in self.older():
+            yield action
+
+    def push(self, raw_actions):
+        """
+        Add actions newer than the cursor from a fresh list of raw dicts.
+        Only the newest `maxlen` of them are built; unfinished actions that
+        are already buffered are updated in place.
+        """
+
+        cursor = self.cursor
+        new = []
+        for action in raw_actions:
+            key = action_key(action)
+            if cursor is None or key > cursor:
+                new.append((key, action))
+            elif key in self.running:
+                obj = self.running[key]
+                for k, v in action.items():
+                    setattr(obj, k, v)
+                if action.get("end_time"):
+                    del self.running[key]
+
+        if not new:
+            return
+
+        if self.maxlen is not None and len(new) > self.maxlen:
+            new = heapq.nlargest(self.maxlen, new, key=lambda x: x[0])
+        new.sort(key=lambda x: x[0])
+
+        for key, action in new:
+            if len(self) == self.maxlen:
+                self.running.pop(action_key(vars(self[0])), None)
+            obj = self.build(action)
+            self.append(obj)
+            if "end_time" in action and not action["end_time"]:
+                self.running[key] = obj
+
+        self.cursor = new[-1][0]
+        self._older = None
+
+
+class HistoryTracker:
+    """
+    Keeps an ActionHistory per object UUID between refreshes, so that
+    a refresh only builds objects for actions that weren't seen before.
+
+    :type build: callable
+    :param build: build(conn, raw_action) -> action object
+
+    :type fetch_all: callable
+    :param fetch_all: fetch_all(conn, uuid) -> list of all raw actions of
+                      an object, used for lazy access to older actions
+    """
+
+    def __init__(self, limit, build, fetch_all):
+        self.limit = limit
+        self.build = build
+        self.fetch_all = fetch_all
+
+        self._histories = {}
+        self._lock = threading.Lock()
+
+    def update(self, conn, uuid, raw_actions):
+        """
+        :rtype: ActionHistory
+        :return: history of the object `uuid`, updated with `raw_actions`
+        """
+
+        with self._lock:
+            history = self._histories.get(uuid)
+            if history is None:
+                history = ActionHistory(
+                    self.limit,
+                    lambda action: self.build(conn, action),
+                    lambda: self.fetch_all(conn, uuid),
+                )
+                self._histories[uuid] = history
+
+            history.push(raw_actions or [])
+            return history
+
+    def retain(self, uuids):
+        """
+        Forget histories of objects not in `uuids`, eg. deleted instances.
+        """
+
+        uuids = set(uuids)
+        with self._lock:
+            for uuid in list(self._histories):
+                if uuid not in uuids:
+                    del self._histories[uuid]
@@ -0,0 +1,97 @@
+"""Module tiktalik.identitymap"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import threading
+import weakref
+
+__all__ = ["IdentityMap"]
+
+
+class IdentityMap:
+    """
+    Interns API objects by class and UUID, so that all references to one
+    entity (eg. the same Network attached to thousands of instances) share
+    a single object. When an already known entity is built again, the
+    existing object is updated in place with the new data and returned.
+
+    Objects are held weakly: entries disappear once nothing else refers
+    to them.
+
+    Attach it to a connection to intern Networks and VPSImages built by that
+    connection:
+
+        conn.identity_map = IdentityMap()
+
+    or pass it to a single list_instances() call.
+    """
+
+    def __init__(self):
+        self._objects = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def build(self, cls, conn, json_dict):
+        """
+        Return the interned `cls` object for json_dict["uuid"], creating it
+        with cls(conn, json_dict) or updating the existing one.
+        """
+
+        uuid = json_dict.get("uuid")
+        if uuid is None:
+            return cls(conn, json_dict)
+
+        key = (cls, uuid)
+        with self._lock:
+            obj = self._objects.get(key)
+            if obj is None:
+                obj = cls(conn, json_dict)
+                self._objects[key] = obj
+            else:
+                for k, v in json_dict.items():
+                    setattr(obj, k, v)
+            return obj
+
+    def get(self, cls, uuid):
+        """
+        :return: the interned `cls` object with given UUID, or None
+        """
+
+        return self._objects.get((cls, uuid))
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+    def __len__(self):
+        return len(self._objects)
+
+
+def intern(cls, conn, json_dict, identity_map=None):
+    """
+    Build a `cls` object through `identity_map`, or the identity map of
+    `conn` if none is given. Without any identity map a new object is built.
+    """
+
+    if identity_map is None:
+        identity_map = getattr(conn, "identity_map", None)
+    if identity_map is None:
+        return cls(conn, json_dict)
+    return identity_map.build(cls, conn, json_dict)
@@ -0,0 +1,307 @@
+"""Module tiktalik.loadbalancer.batch"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import threading
+from collections import OrderedDict
+
+
+class MutationQueue:
+    """
+    Buffers backend and domain changes of a LoadBalancer and applies them
+    together. Calls made within `window` seconds of the first queued one are
+    coalesced: only the difference between the load balancer's state and the
+    final state they describe is sent, so opposing operations (eg. adding
+    and removing the same backend) cancel out. A single change is sent with
+    its own call, more of them with one set_backends() or set_domains() call.
+
+        queue = lb.batch(window=0.1)
+        queue.add_backend("10.0.0.5", 80, 10)
+        queue.remove_backend(old_backend_uuid)
+
+    With `window` None, the default, changes are only sent by flush(), or at
+    the end of a `with` block:
+
+        with lb.batch() as queue:
+            for ip in addresses:
+                queue.add_backend(ip, 80, 10)
+
+    After a flush the load balancer's `backends` and `domains` attributes
+    describe the applied state; it's fetched again when the server assigned
+    new backend UUIDs.
+
+    Backends are identified by address (ip, port). Errors of flushes started
+    by the window timer are passed to `on_error`, if given, and kept in the
+    `error` attribute; the changes stay queued for the next flush.
+    """
+
+    def __init__(self, loadbalancer, window=None, on_error=None):
+        self.loadbalancer = loadbalancer
+        self.window = window
+        self.on_error = on_error
+        self.error = None
+
+        # backend UUID -> address, for calls that take an UUID
+        self._uuids = dict((b.uuid, (b.ip, b.port)) for b in loadbalancer.backends)
+        # set_backends() was called, the server may know other UUIDs now
+        self._uuids_stale = False
+        # applied state, address -> weight
+        self._backends = OrderedDict(
+            ((b.ip, b.port), b.weight) for b in loadbalancer.backends
+        )
+        self._domains = list(getattr(loadbalancer, "domains", None) or [])
+
+        # desired state, None when there are no pending changes
+        self._want_backends = None
+        self._want_domains = None
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def add_backend(self, ip, port, weight):
+        with self._lock:
+            self._backends_view()[(ip, port)] = weight
+            self._schedule()
+
+    def remove_backend(self, backend):
+        """
+        :type backend: string or tuple
+        :param backend: backend UUID or its (ip, port)
+        """
+
+        with self._lock:
+            self._backends_view().pop(self._address(backend), None)
+            self._schedule()
+
+    def modify_backend(self, backend, ip=None, port=None, weight=None):
+        """
+        :type backend: string or tuple
+        :param backend: backend UUID or its (ip, port)
+        """
+
+        with self._lock:
+            address = self._address(backend)
+            current = self._want_backends
+            if address not in (self._backends if current is None else current):
+                raise ValueError("Unknown backend: %s:%s" % address)
+            view = self._backends_view()
+            old = view.pop(address)
+            new = (ip or address[0], port or address[1])
+            view[new] = weight if weight is not None else old
+            for uuid, a in self._uuids.items():
+                if a == address:
+                    self._uuids[uuid] = new
+            self._schedule()
+
+    def add_domain(self, domain):
+        with self._lock:
+            view = self._domains_view()
+            if domain not in view:
+                view.append(domain)
+            self._schedule()
+
+    def remove_domain(self, domain):
+        with self._lock:
+            view = self._domains_view()
+            if domain in view:
+                view.remove(domain)
+            self._schedule()
+
+    @property
+    def pending(self):
+        """
+        :return: True if there are changes not sent yet
+        """
+
+        with self._lock:
+            return self._want_backends is not None or self._want_domains is not None
+
+    def discard(self):
+        """
+        Drop all changes not sent yet.
+        """
+
+        with self._lock:
+            self._cancel_timer()
+            self._want_backends = None
+            self._want_domains = None
+
+    def flush(self):
+        """
+        Send the queued changes now.
+
+        :rtype: int
+        :return: number of API calls made
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                self._cancel_timer()
+                backends = self._want_backends
+                domains = self._want_domains
+                if backends is not None:
+                    backends = OrderedDict(backends)
+                if domains is not None:
+                    domains = list(domains)
+
+            calls = 0
+            if backends is not None:
+                calls += self._apply_backends(backends)
+                with self._lock:
+                    self._backends = backends
+                    if self._want_backends == backends:
+                        self._want_backends = None
+                self._sync_backends(backends)
+            if domains is not None:
+                calls += self._apply_domains(domains)
+                with self._lock:
+                    self._domains = domains
+                    self.loadbalancer.domains = list(domains)
+                    if self._want_domains == domains:
+                        self._want_domains = None
+            return calls
+
+    def _apply_backends(self, want):
+        lb = self.loadbalancer
+        base = self._backends
+        added = [a for a in want if a not in base]
+        removed = [a for a in base if a not in want]
+        changed = [a for a in want if a in base and base[a] != want[a]]
+
+        if len(added) + len(removed) + len(changed) == 1:
+            if added:
+                ip, port = added[0]
+                lb.add_backend(ip, port, want[added[0]])
+                # UUID of the new backend is only known to the server
+                self._uuids_stale = True
+                return 1
+            uuid = self._uuid(removed[0] if removed else changed[0])
+            if uuid is not None:
+                if removed:
+                    lb.remove_backend(uuid)
+                else:
+                    lb.modify_backend(uuid, weight=want[changed[0]])
+                return 1
+        elif not (added or removed or changed):
+            return 0
+
+        lb.set_backends([(ip, port, w) for ((ip, port), w) in want.items()])
+        # the server may assign new UUIDs to the backends
+        self._uuids_stale = True
+        return 1
+
+    def _sync_backends(self, applied):
+        """
+        Bring loadbalancer.backends up to date with the applied state, so
+        that queues created later start from it. The load balancer is fetched
+        again if the server assigned backend UUIDs we don't know.
+        """
+
+        lb = self.loadbalancer
+        if self._uuids_stale:
+            fresh = lb.conn.get_loadbalancer(lb.uuid)
+            with self._lock:
+                lb.backends = fresh.backends
+                self._uuids = dict((b.uuid, (b.ip, b.port)) for b in fresh.backends)
+                self._uuids_stale = False
+            return
+
+        with self._lock:
+            lb.backends = [b for b in lb.backends if (b.ip, b.port) in applied]
+            for b in lb.backends:
+                b.weight = applied[(b.ip, b.port)]
+            self._uuids = dict(
+                (uuid, a) for (uuid, a) in self._uuids.items() if a in applied
+            )
+
+    def _apply_domains(self, want):
+        lb = self.loadbalancer
+        added = [d for d in want if d not in self._domains]
+        removed = [d for d in self._domains if d not in want]
+
+        if len(added) + len(removed) == 1:
+            if added:
+                lb.add_domain(added[0])
+            else:
+                lb.remove_domain(removed[0])
+            return 1
+        if added or removed:
+            lb.set_domains(want)
+            return 1
+        return 0
+
+    def _address(self, backend):
+        if isinstance(backend, str):
+            try:
+                return self._uuids[backend]
+            except KeyError:
+                raise ValueError("Unknown backend: %s" % backend)
+        return tuple(backend[:2])
+
+    def _uuid(self, address):
+        if self._uuids_stale:
+            return None
+        with self._lock:
+            for uuid, a in self._uuids.items():
+                if a == address:
+                    return uuid
+        return None
+
+    def _backends_view(self):
+        if self._want_backends is None:
+            self._want_backends = OrderedDict(self._backends)
+        return self._want_backends
+
+    def _domains_view(self):
+        if self._want_domains is None:
+            self._want_domains = list(self._domains)
+        return self._want_domains
+
+    def _schedule(self):
+        if self.window is None or self._timer is not None:
+            return
+        self._timer = threading.Timer(self.window, self._timer_flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _timer_flush(self):
+        try:
+            self.flush()
+            self.error = None
+        except Exception as e:
+            self.error = e
+            if self.on_error is not None:
+                self.on_error(e)
@@ -20,20 +20,64 @@
 
 from .objects import *
 from ..connection import TiktalikAuthConnection
+from ..history import HistoryTracker
+from ..tracing import traced
+from ..filters import compile_filter
 
 
 class LoadBalancerConnection(TiktalikAuthConnection):
+    _action_history = None
+
+    # Fields the API filters on when passed as query parameters, per
+    # resource ("loadbalancer"); other filter conditions are evaluated locally.
+    server_filters = {}
+
     def base_url(self):
         return "/api/v1/loadbalancer"
 
-    def list_loadbalancers(self, history=False):
-        response = self.request("GET", "", query_params=dict(history=history))
-        return [LoadBalancer(self, i) for i in response]
+    @traced
+    def list_loadbalancers(self, history=False, history_limit=None, filter=None):
+        """
+        List all load balancers.
+
+        :type history: boolean
+        :param history: include history of operations in each LoadBalancer
+
+        :type history_limit: int
+        :param history_limit: with `history`, keep only this many newest entries
+                              per LoadBalancer, in an ActionHistory. Repeated
+                              calls only build objects for new entries.
+
+        :type filter: dict or callable
+        :param filter: only return load balancers matching it, checked before
+                       any object is built; see tiktalik.filters.compile_filter()
+        """
+
+        match, query = compile_filter(
+            filter, self.server_filters.get("loadbalancer", ())
+        )
+        query.update(history=history)
+        response = self.request("GET", "", query_params=query)
+        matching = response if match is None else [i for i in response if match(i)]
+
+        if history and history_limit:
+            tracker = self._action_history
+            if tracker is None or tracker.limit != history_limit:
+                tracker = self._action_history = HistoryTracker(
+                    history_limit, LoadBalancerAction, _fetch_loadbalancer_history
+                )
+            for i in matching:
+                i["history"] = tracker.update(self, i["uuid"], i.get("history"))
+            tracker.retain(i["uuid"] for i in response)
 
+        return [LoadBalancer(self, i) for i in matching]
+
+    @traced
     def get_loadbalancer(self, uuid):
         response = self.request("GET", "/%s" % uuid)
         return LoadBalancer(self, response)
 
+    @traced
     def create_loadbalancer(
         self, name, proto, address=None, port=None, backends=None, domains=None
     ):
@@ -73,3 +117,9 @@ class LoadBalancerConnection(TiktalikAuthConnection):
 
         response = self.request("POST", "", params)
         return LoadBalancer(self, response)
+
+
+def _fetch_loadbalancer_history(conn, uuid):
+    return conn.request("GET", "/%s" % uuid, query_params=dict(history=True)).get(
+        "history", []
+    )
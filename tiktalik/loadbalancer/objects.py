@@ -22,6 +22,7 @@
 
 from ..error import TiktalikAPIError
 from ..apiobject import APIObject
+from ..history import ActionHistory
 
 __all__ = ["LoadBalancer", "LoadBalancerBackend", "LoadBalancerAction"]
 
@@ -38,9 +39,12 @@ class LoadBalancer(APIObject):
 
         self.backends = [LoadBalancerBackend(conn, i) for i in self.backends]
         self.monitor = LoadBalancerBackendMonitor(conn, self.monitor)
-        self.history = (
-            [LoadBalancerAction(conn, i) for i in self.history] if self.history else []
-        )
+        if not isinstance(self.history, ActionHistory):
+            self.history = (
+                [LoadBalancerAction(conn, i) for i in self.history]
+                if self.history
+                else []
+            )
 
     def __str__(self):
         return "<LoadBalancer:(%s) %s>" % (self.uuid, self.name)
@@ -119,6 +123,18 @@ class LoadBalancer(APIObject):
             {"backends[]": ["%s:%i:%i" % b for b in backends]},
         )
 
+    def batch(self, window=None, on_error=None):
+        """
+        Return a MutationQueue that coalesces backend and domain changes of
+        this load balancer into as few API calls as possible.
+
+        :seealso: tiktalik.loadbalancer.batch.MutationQueue
+        """
+
+        from .batch import MutationQueue
+
+        return MutationQueue(self, window, on_error)
+
     def add_backend(self, ip, port, weight):
         return self.conn.request(
             "PUT",
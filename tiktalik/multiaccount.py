@@ -0,0 +1,320 @@
+"""Module tiktalik.multiaccount"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import contextmanager
+
+from .apiobject import APIObject
+from .error import TiktalikTimeoutError
+from .deadline import Deadline, current_deadline, deadline
+from .computing.connection import ComputingConnection
+from .loadbalancer.connection import LoadBalancerConnection
+
+__all__ = ["Account", "AccountRecord", "FanOutResult", "MultiAccountClient"]
+
+
+Account = namedtuple("Account", ["name", "api_key", "api_secret_key"])
+
+AccountRecord = namedtuple("AccountRecord", ["account", "kind", "uuid", "data"])
+
+
+_SERVICES = {
+    "computing": ComputingConnection,
+    "loadbalancer": LoadBalancerConnection,
+}
+
+# Connections owned by a worker process, keyed by (account name, service,
+# connection options). They are created on first use and kept open for the
+# lifetime of the worker, so consecutive tasks reuse the HTTP connections.
+_worker_connections = {}
+
+
+def _worker_connection(account, service, options):
+    key = (account.name, service, options)
+    conn = _worker_connections.get(key)
+    if conn is None:
+        conn = _SERVICES[service](
+            account.api_key, account.api_secret_key, keep_alive=True, **dict(options)
+        )
+        _worker_connections[key] = conn
+    return conn
+
+
+def record_data(value):
+    """
+    Convert an API object (or a list of them) to plain dicts and lists,
+    dropping the connection reference. The result is cheap to pickle.
+    """
+
+    if isinstance(value, APIObject):
+        return dict(
+            (k, record_data(v)) for (k, v) in vars(value).items() if k != "conn"
+        )
+    if isinstance(value, (list, tuple)):
+        return [record_data(v) for v in value]
+    return value
+
+
+def _to_records(account_name, result, transform):
+    if not isinstance(result, list):
+        result = [result]
+
+    records = []
+    for obj in result:
+        data = transform(obj) if transform else record_data(obj)
+        if isinstance(obj, APIObject):
+            uuid = getattr(obj, "uuid", None)
+        else:
+            uuid = obj.get("uuid") if isinstance(obj, dict) else None
+        records.append(AccountRecord(account_name, type(obj).__name__, uuid, data))
+    return records
+
+
+# time allowed, after the caller's deadline, for results of calls that
+# failed on the deadline to come back from the workers
+_RESULT_GRACE = 1.0
+
+
+@contextmanager
+def _budget(budget):
+    if budget is None:
+        yield
+    else:
+        # the monotonic clock isn't comparable between processes
+        timeout, expires_at = budget
+        limit = Deadline(timeout)
+        limit.expires = time.monotonic() + (expires_at - time.time())
+        with deadline(limit):
+            yield
+
+
+def _run_task(account, service, options, method, args, kwargs, transform, budget):
+    """
+    Worker entry point. Returns a tuple (account name, records, error).
+
+    `budget` is the caller's deadline as a tuple (timeout, expiry time as
+    returned by time.time()), it becomes the deadline of the call made by
+    the worker. Time the task spent waiting for a worker counts too.
+    """
+
+    conn = _worker_connection(account, service, options)
+    try:
+        with _budget(budget):
+            result = getattr(conn, method)(*args, **kwargs)
+    except Exception as e:
+        # eg. TiktalikAPIError, or a network error of an unreachable account
+        return account.name, [], e
+
+    return account.name, _to_records(account.name, result, transform), None
+
+
+class FanOutResult:
+    """
+    Merged result of a call performed on many accounts.
+
+    Attributes:
+        records: List[AccountRecord] - records from all accounts, in the
+                 order the accounts were passed to MultiAccountClient
+        errors: dict - account name -> exception (TiktalikAPIError, network
+                error) for accounts that failed
+    """
+
+    def __init__(self, records, errors):
+        self.records = records
+        self.errors = errors
+
+    def by_account(self):
+        """
+        :rtype: dict
+        :return: account name -> list of AccountRecord
+        """
+
+        ret = {}
+        for record in self.records:
+            ret.setdefault(record.account, []).append(record)
+        return ret
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+
+class MultiAccountClient:
+    """
+    Performs the same API calls on many accounts in parallel, using a pool
+    of worker processes. JSON decoding and object construction happen in
+    the workers, only compact AccountRecord tuples are sent back.
+
+    Each worker keeps its own keep-alive connections per account, so
+    subsequent calls don't pay for new TCP and TLS handshakes.
+
+    :type accounts: list
+    :param accounts: list of Account tuples (name, api_key, api_secret_key)
+
+    :type processes: int
+    :param processes: number of worker processes, defaults to the number of CPUs
+
+    Remaining keyword arguments (host, port, use_ssl, pool_size) are passed
+    to the connections created in workers.
+    """
+
+    def __init__(self, accounts, processes=None, **conn_options):
+        self.accounts = [Account(*a) for a in accounts]
+        names = [a.name for a in self.accounts]
+        if len(set(names)) != len(names):
+            raise ValueError("Account names must be unique.")
+
+        self.conn_options = tuple(sorted(conn_options.items()))
+        self._executor = ProcessPoolExecutor(max_workers=processes)
+
+    def close(self):
+        """
+        Shut down worker processes.
+        """
+
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def call(self, service, method, *args, **kwargs):
+        """
+        Call `method` of a connection for `service` ("computing" or
+        "loadbalancer") with the same arguments on every account.
+
+        A `transform` keyword argument may be given: a picklable function
+        that is applied to each returned object in the worker process and
+        whose return value becomes the record data.
+
+        :rtype: FanOutResult
+        """
+
+        transform = kwargs.pop("transform", None)
+        calls = [(a.name, args, kwargs) for a in self.accounts]
+        return self.bulk(service, method, calls, transform=transform)
+
+    def bulk(self, service, method, calls, transform=None):
+        """
+        Perform many calls of `method`, each on a given account.
+
+        If a deadline (see tiktalik.deadline) is active in the calling thread,
+        it's passed on to the workers, and calls that didn't complete when
+        it expired are reported in `errors` with TiktalikTimeoutError.
+
+        :type calls: list
+        :param calls: list of (account name, args, kwargs) tuples
+
+        :rtype: FanOutResult
+        """
+
+        if service not in _SERVICES:
+            raise ValueError("Unknown service: %s" % service)
+
+        limit = current_deadline()
+        budget = None
+        if limit is not None:
+            budget = (limit.timeout, time.time() + limit.check("connect"))
+
+        accounts = dict((a.name, a) for a in self.accounts)
+        futures = [
+            self._executor.submit(
+                _run_task,
+                accounts[name],
+                service,
+                self.conn_options,
+                method,
+                tuple(args),
+                dict(kwargs),
+                transform,
+                budget,
+            )
+            for (name, args, kwargs) in calls
+        ]
+
+        wait_for = None
+        if limit is not None:
+            wait_for = max(0, limit.remaining()) + _RESULT_GRACE
+        wait(futures, wait_for)
+
+        results = []
+        for (name, _, _), future in zip(calls, futures):
+            if future.done():
+                results.append(future.result())
+            else:
+                future.cancel()
+                results.append((name, [], TiktalikTimeoutError("queue", limit.timeout)))
+
+        order = dict((a.name, i) for (i, a) in enumerate(self.accounts))
+        results.sort(key=lambda r: order[r[0]])
+
+        records = []
+        errors = {}
+        for name, account_records, error in results:
+            records.extend(account_records)
+            if error is not None:
+                errors[name] = error
+
+        return FanOutResult(records, errors)
+
+    def list_instances(self, actions=False, vpsimage=False, cost=False, transform=None):
+        """
+        :seealso: ComputingConnection.list_instances()
+        """
+
+        return self.call(
+            "computing",
+            "list_instances",
+            actions=actions,
+            vpsimage=vpsimage,
+            cost=cost,
+            transform=transform,
+        )
+
+    def list_images(self, transform=None):
+        """
+        :seealso: ComputingConnection.list_images()
+        """
+
+        return self.call("computing", "list_images", transform=transform)
+
+    def list_networks(self, transform=None):
+        """
+        :seealso: ComputingConnection.list_networks()
+        """
+
+        return self.call("computing", "list_networks", transform=transform)
+
+    def list_loadbalancers(self, history=False, transform=None):
+        """
+        :seealso: LoadBalancerConnection.list_loadbalancers()
+        """
+
+        return self.call(
+            "loadbalancer", "list_loadbalancers", history=history, transform=transform
+        )
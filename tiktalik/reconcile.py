@@ -0,0 +1,475 @@
+"""Module tiktalik.reconcile"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .deadline import current_deadline, deadline
+from .scheduler import caller_priority, priority
+
+__all__ = ["Planner", "Plan", "PlanResult", "Step"]
+
+
+class Step:
+    """
+    A single API operation of a Plan.
+
+    Attributes:
+        kind: string - eg. "create_network", "add_interface", "set_backends"
+        target: string - name of the network, instance or load balancer
+        description: string - human readable description
+        depends: List[Step] - steps that must succeed before this one runs
+    """
+
+    def __init__(self, kind, target, description, action, depends=()):
+        self.kind = kind
+        self.target = target
+        self.description = description
+        self.action = action
+        self.depends = list(depends)
+
+    def __str__(self):
+        return self.description
+
+    def __repr__(self):
+        return "<Step: %s>" % self.description
+
+
+class PlanResult:
+    """
+    Outcome of Plan.execute().
+
+    Attributes:
+        results: dict - Step -> value returned by the API call
+        errors: dict - Step -> exception raised by the API call
+        skipped: List[Step] - steps not run because a dependency failed
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+        self.skipped = []
+
+    @property
+    def ok(self):
+        return not self.errors and not self.skipped
+
+
+class Plan:
+    """
+    A dependency graph of API operations that converge the current state to
+    the desired one. Steps are kept in an order that respects dependencies.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def format(self):
+        """
+        :rtype: string
+        :return: the plan as text, one numbered step per line, with the
+                 numbers of steps it waits for
+        """
+
+        if not self.steps:
+            return "Nothing to do."
+
+        index = dict((step, i + 1) for (i, step) in enumerate(self.steps))
+        lines = []
+        for step in self.steps:
+            line = "%3d. %s" % (index[step], step.description)
+            if step.depends:
+                line += "  (after %s)" % ", ".join(
+                    "#%d" % index[d] for d in step.depends
+                )
+            lines.append(line)
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.format()
+
+    def execute(self, max_workers=4):
+        """
+        Run the plan. Steps whose dependencies are done run in parallel,
+        at most `max_workers` at a time. When a step fails, steps depending
+        on it (directly or not) are skipped, independent ones still run.
+        A deadline and priority (see tiktalik.scheduler) active in the
+        calling thread apply to all steps.
+
+        :rtype: PlanResult
+        """
+
+        result = PlanResult()
+        budget = current_deadline()
+        level = caller_priority()
+        waiting = list(self.steps)
+        running = {}
+
+        def run(step):
+            with priority(*level):
+                if budget is None:
+                    return step.action()
+                with deadline(budget):
+                    return step.action()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while waiting or running:
+                for step in list(waiting):
+                    failed = [
+                        d for d in step.depends if d in result.errors or d in result.skipped
+                    ]
+                    if failed:
+                        waiting.remove(step)
+                        result.skipped.append(step)
+                    elif all(d in result.results for d in step.depends):
+                        waiting.remove(step)
+                        running[executor.submit(run, step)] = step
+
+                if not running:
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        result.results[step] = future.result()
+                    except Exception as e:
+                        result.errors[step] = e
+
+        return result
+
+
+class _Context:
+    """
+    Names resolved while a plan runs: networks and instances created by
+    earlier steps are registered here for the steps depending on them.
+    """
+
+    def __init__(self, networks, instances):
+        self.networks = networks
+        self.instances = instances
+        self.lock = threading.Lock()
+
+    def network_uuid(self, ref):
+        """
+        :return: UUID of the network named `ref`, or `ref` if it's a UUID
+        """
+
+        with self.lock:
+            return self.networks.get(ref, ref)
+
+    def add_network(self, name, uuid):
+        with self.lock:
+            self.networks[name] = uuid
+
+
+class Planner:
+    """
+    Computes and runs the operations needed to reach a desired state,
+    described with plain dicts, eg. loaded from a config file:
+
+        desired = {
+            "networks": [{"name": "backend"}],
+            "instances": [
+                {"hostname": "web1", "size": "1s", "image_uuid": "...",
+                 "networks": ["backend"], "disk_size_gb": 20},
+            ],
+            "loadbalancers": [
+                {"name": "www", "proto": "HTTP", "domains": ["example.com"],
+                 "backends": [("web1", 80, 10), ("10.0.0.7", 80, 10)]},
+            ],
+        }
+
+        planner = Planner(ComputingConnection(...), LoadBalancerConnection(...))
+        plan = planner.plan(desired)
+        print(plan)             # dry run
+        plan.execute()
+
+    Instance networks may be given by network name or UUID. Load balancer
+    backend hosts may be IP addresses or instance hostnames, which resolve to
+    the address of the instance's first interface.
+
+    The current state is read once per plan(), with one list call per kind
+    of object. Objects that exist but aren't in the desired state are left
+    alone, unless `prune` is set - then interfaces not in the desired state
+    are removed from managed instances.
+    """
+
+    def __init__(self, computing, loadbalancer=None, prune=False):
+        self.computing = computing
+        self.loadbalancer = loadbalancer
+        self.prune = prune
+
+    def snapshot(self):
+        """
+        Fetch the current state.
+
+        :rtype: dict
+        :return: dict with "networks", "instances" and "loadbalancers" lists
+        """
+
+        return {
+            "networks": self.computing.list_networks(),
+            "instances": self.computing.list_instances(),
+            "loadbalancers": (
+                self.loadbalancer.list_loadbalancers()
+                if self.loadbalancer is not None
+                else []
+            ),
+        }
+
+    def plan(self, desired, snapshot=None):
+        """
+        Diff `desired` against the current state.
+
+        :type snapshot: dict
+        :param snapshot: current state, as returned by snapshot(); fetched
+                         if not given
+
+        :rtype: Plan
+        """
+
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        networks = {}
+        network_uuids = set()
+        for n in snapshot["networks"]:
+            networks.setdefault(n.name, n.uuid)
+            network_uuids.add(n.uuid)
+
+        instances = {}
+        for i in snapshot["instances"]:
+            instances.setdefault(i.hostname, i)
+
+        context = _Context(networks, instances)
+        steps = []
+        created_networks = {}
+        created_instances = {}
+
+        for spec in desired.get("networks", []):
+            name = spec["name"]
+            if name not in networks and name not in created_networks:
+                step = Step(
+                    "create_network",
+                    name,
+                    "create network %s" % name,
+                    self._create_network(context, name),
+                )
+                created_networks[name] = step
+                steps.append(step)
+
+        def network_step(ref):
+            if ref in network_uuids or ref in networks:
+                return None
+            if ref not in created_networks:
+                raise ValueError("Unknown network: %s" % ref)
+            return created_networks[ref]
+
+        for spec in desired.get("instances", []):
+            hostname = spec["hostname"]
+            refs = spec.get("networks", [])
+            depends = [s for s in map(network_step, refs) if s is not None]
+
+            instance = instances.get(hostname)
+            if instance is None:
+                step = Step(
+                    "create_instance",
+                    hostname,
+                    "create instance %s (%s) in %s"
+                    % (hostname, spec["size"], ", ".join(refs) or "no networks"),
+                    self._create_instance(context, spec),
+                    depends,
+                )
+                created_instances[hostname] = step
+                steps.append(step)
+                continue
+
+            attached = dict((i.network.uuid, i) for i in instance.interfaces)
+            attached_names = dict((i.network.name, i) for i in instance.interfaces)
+            wanted = set()
+            seq = max([i.seq for i in instance.interfaces] or [-1]) + 1
+            for ref, dep in zip(refs, map(network_step, refs)):
+                interface = attached.get(ref) or attached_names.get(ref)
+                if interface is not None:
+                    wanted.add(interface.uuid)
+                    continue
+                steps.append(
+                    Step(
+                        "add_interface",
+                        hostname,
+                        "attach network %s to %s as eth%d" % (ref, hostname, seq),
+                        self._add_interface(context, instance.uuid, ref, seq),
+                        [dep] if dep is not None else [],
+                    )
+                )
+                seq += 1
+
+            if self.prune:
+                for interface in instance.interfaces:
+                    if interface.uuid not in wanted:
+                        steps.append(
+                            Step(
+                                "remove_interface",
+                                hostname,
+                                "detach eth%d (%s) from %s"
+                                % (interface.seq, interface.network.name, hostname),
+                                self._remove_interface(instance.uuid, interface.uuid),
+                            )
+                        )
+
+        if desired.get("loadbalancers") and self.loadbalancer is None:
+            raise ValueError("A LoadBalancerConnection is needed for load balancers")
+
+        balancers = dict((lb.name, lb) for lb in snapshot["loadbalancers"])
+        for spec in desired.get("loadbalancers", []):
+            name = spec["name"]
+            backends = [tuple(b) for b in spec.get("backends", [])]
+            domains = list(spec.get("domains", []))
+            depends = [
+                created_instances[b[0]] for b in backends if b[0] in created_instances
+            ]
+            resolve = self._resolver(context, backends)
+
+            lb = balancers.get(name)
+            if lb is None:
+                steps.append(
+                    Step(
+                        "create_loadbalancer",
+                        name,
+                        "create %s load balancer %s with %d backends"
+                        % (spec["proto"], name, len(backends)),
+                        self._create_loadbalancer(spec, resolve, domains),
+                        depends,
+                    )
+                )
+                continue
+
+            current = set((b.ip, b.port, b.weight) for b in lb.backends)
+            if depends or set(resolve()) != current:
+                steps.append(
+                    Step(
+                        "set_backends",
+                        name,
+                        "set backends of %s: %s"
+                        % (name, ", ".join("%s:%s:%s" % b for b in backends)),
+                        lambda lb=lb, resolve=resolve: lb.set_backends(resolve()),
+                        depends,
+                    )
+                )
+
+            if set(domains) != set(getattr(lb, "domains", None) or []):
+                steps.append(
+                    Step(
+                        "set_domains",
+                        name,
+                        "set domains of %s: %s" % (name, ", ".join(domains)),
+                        lambda lb=lb, domains=domains: lb.set_domains(domains),
+                    )
+                )
+
+        return Plan(steps)
+
+    def _create_network(self, context, name):
+        def run():
+            network = self.computing.create_network(name)
+            context.add_network(name, network.uuid)
+            return network
+
+        return run
+
+    def _create_instance(self, context, spec):
+        def run():
+            networks = [context.network_uuid(ref) for ref in spec.get("networks", [])]
+            return self.computing.create_instance(
+                spec["hostname"],
+                spec["size"],
+                spec["image_uuid"],
+                networks,
+                ssh_key=spec.get("ssh_key"),
+                disk_size_gb=spec.get("disk_size_gb"),
+            )
+
+        return run
+
+    def _add_interface(self, context, instance_uuid, ref, seq):
+        def run():
+            network = context.network_uuid(ref)
+            return self.computing.add_network_interface(instance_uuid, network, seq)
+
+        return run
+
+    def _remove_interface(self, instance_uuid, interface_uuid):
+        return lambda: self.computing.remove_network_interface(
+            instance_uuid, interface_uuid
+        )
+
+    def _resolver(self, context, backends):
+        """
+        Return a function that turns backend hosts given as hostnames into
+        IP addresses. Instances unknown to the snapshot (created by the plan)
+        are looked up when the function is called.
+        """
+
+        def resolve():
+            ret = []
+            for host, port, weight in backends:
+                instance = context.instances.get(host)
+                if instance is None and not _is_address(host):
+                    instance = self.computing.list_instances()
+                    instance = dict((i.hostname, i) for i in instance).get(host)
+                    if instance is None:
+                        raise ValueError("Unknown backend host: %s" % host)
+                if instance is not None:
+                    interfaces = sorted(instance.interfaces, key=lambda i: i.seq)
+                    if not interfaces:
+                        raise ValueError("Instance %s has no interfaces" % host)
+                    host = interfaces[0].ip
+                ret.append((host, port, weight))
+            return ret
+
+        return resolve
+
+    def _create_loadbalancer(self, spec, resolve, domains):
+        return lambda: self.loadbalancer.create_loadbalancer(
+            spec["name"],
+            spec["proto"],
+            address=spec.get("address"),
+            port=spec.get("port"),
+            backends=resolve(),
+            domains=domains or None,
+        )
+
+
+def _is_address(host):
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
@@ -0,0 +1,240 @@
+"""Module tiktalik.scheduler"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import bisect
+import itertools
+import threading
+from contextlib import contextmanager
+
+__all__ = [
+    "RequestScheduler",
+    "priority",
+    "current_priority",
+    "caller_priority",
+    "INTERACTIVE",
+    "NORMAL",
+    "BULK",
+]
+
+
+INTERACTIVE = "interactive"
+NORMAL = "normal"
+BULK = "bulk"
+
+
+_local = threading.local()
+
+
+def current_priority():
+    """
+    :rtype: tuple
+    :return: (priority class, caller) set by the innermost priority() block
+             of this thread, or (NORMAL, None)
+    """
+
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else (NORMAL, None)
+
+
+def caller_priority():
+    """
+    Like current_priority(), but with the caller defaulting to the current
+    thread. Worker threads making requests on behalf of this thread enter
+    priority(*caller_priority()), so they share its class and its fair share
+    instead of each being a flow of its own.
+
+    :rtype: tuple
+    :return: (priority class, caller)
+    """
+
+    name, caller = current_priority()
+    if caller is None:
+        caller = threading.get_ident()
+    return name, caller
+
+
+@contextmanager
+def priority(name, caller=None):
+    """
+    Set the priority class of all API calls made in this thread within the
+    `with` block:
+
+        with priority(BULK, caller="nightly-report"):
+            for instance in conn.list_instances():
+                instance.load_block_devices()
+
+    :type name: string
+    :param name: priority class, eg. INTERACTIVE, NORMAL or BULK
+
+    :type caller: hashable
+    :param caller: identifies the caller for fair queuing within the class;
+                   defaults to the current thread
+    """
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    stack.append((name, caller))
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+class _Ticket:
+    __slots__ = ("finish", "seq", "name", "start")
+
+    def __init__(self, finish, seq, name, start):
+        self.finish = finish
+        self.seq = seq
+        self.name = name
+        self.start = start
+
+    def __lt__(self, other):
+        return (self.finish, self.seq) < (other.finish, other.seq)
+
+
+class RequestScheduler:
+    """
+    Orders requests of connections sharing it when more of them are made
+    than `concurrency` allows at once. Pass an instance as `scheduler` to
+    connections to enable it.
+
+    Every request belongs to a priority class, set with priority(). Waiting
+    requests are served in weighted fair queuing order: each caller (thread,
+    or the `caller` given to priority()) is a flow, and flows get a share of
+    the slots proportional to their class weight - a BULK job can't starve
+    INTERACTIVE calls, and one busy thread can't starve the other threads of
+    its class. Classes may also have their own concurrency limit.
+
+    :type concurrency: int
+    :param concurrency: maximum number of requests in progress
+
+    :type classes: dict
+    :param classes: name -> dict(weight=float, limit=int or None); the default
+                    gives INTERACTIVE weight 8, NORMAL 4 and BULK 1, with BULK
+                    limited to a quarter of `concurrency`
+    """
+
+    def __init__(self, concurrency=8, classes=None):
+        if classes is None:
+            classes = {
+                INTERACTIVE: dict(weight=8),
+                NORMAL: dict(weight=4),
+                BULK: dict(weight=1, limit=max(1, concurrency // 4)),
+            }
+
+        self.concurrency = concurrency
+        self.classes = classes
+
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = dict((name, 0) for name in classes)
+        self._total = 0
+        self._vtime = 0.0
+        self._finish = {}
+        self._seq = itertools.count()
+
+    def _weight(self, name):
+        try:
+            return self.classes[name].get("weight", 1)
+        except KeyError:
+            raise ValueError("Unknown priority class: %s" % name)
+
+    def _runnable(self):
+        """
+        :return: the first waiting ticket that may run now, or None
+        """
+
+        if self._total >= self.concurrency:
+            return None
+        for ticket in self._waiting:
+            limit = self.classes[ticket.name].get("limit")
+            if limit is None or self._running[ticket.name] < limit:
+                return ticket
+        return None
+
+    @contextmanager
+    def slot(self, deadline=None):
+        """
+        Wait for a turn of the current priority class and caller, hold it for
+        the duration of the `with` block. Raise TiktalikTimeoutError for the
+        "queue" phase if `deadline` expires first.
+        """
+
+        name, caller = current_priority()
+        weight = self._weight(name)
+        if caller is None:
+            caller = threading.get_ident()
+        flow = (name, caller)
+
+        with self._cond:
+            start = max(self._vtime, self._finish.get(flow, 0.0))
+            ticket = _Ticket(start + 1.0 / weight, next(self._seq), name, start)
+            self._finish[flow] = ticket.finish
+            bisect.insort(self._waiting, ticket)
+
+            try:
+                while self._runnable() is not ticket:
+                    timeout = None
+                    if deadline is not None:
+                        timeout = deadline.check("queue")
+                    self._cond.wait(timeout)
+            except BaseException:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+                raise
+
+            self._waiting.remove(ticket)
+            self._running[name] += 1
+            self._total += 1
+            self._vtime = max(self._vtime, ticket.start)
+            # there may be room for more than this one
+            self._cond.notify_all()
+            if len(self._finish) > 1024:
+                self._finish = dict(
+                    (k, v) for (k, v) in self._finish.items() if v > self._vtime
+                )
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running[name] -= 1
+                self._total -= 1
+                self._cond.notify_all()
+
+    def stats(self):
+        """
+        :rtype: dict
+        :return: priority class -> dict(running=int, waiting=int)
+        """
+
+        with self._cond:
+            ret = dict(
+                (name, dict(running=self._running[name], waiting=0))
+                for name in self.classes
+            )
+            for ticket in self._waiting:
+                ret[ticket.name]["waiting"] += 1
+            return ret
@@ -0,0 +1,162 @@
+"""Module tiktalik.serialization"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import pickle
+from collections import deque
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .apiobject import APIObject
+from .computing import objects as computing_objects
+from .loadbalancer import objects as loadbalancer_objects
+
+__all__ = ["dumps", "loads", "register"]
+
+
+# Format: MAGIC, one byte naming the codec, then the encoded payload.
+MAGIC = b"TKS1"
+PICKLE = b"p"
+MSGPACK = b"m"
+
+# markers used in encoded object dicts
+_TYPE = "__t"
+_ID = "__i"
+_REF = "__r"
+
+_classes = {}
+
+
+def register(cls):
+    """
+    Make an APIObject subclass known to dumps() and loads(). All classes
+    from tiktalik.computing.objects and tiktalik.loadbalancer.objects are
+    registered already.
+    """
+
+    _classes[cls.__name__] = cls
+    return cls
+
+
+for _module in (computing_objects, loadbalancer_objects):
+    for _value in list(vars(_module).values()):
+        if (
+            isinstance(_value, type)
+            and issubclass(_value, APIObject)
+            and _value is not APIObject
+        ):
+            register(_value)
+
+
+def dumps(objects, codec=None):
+    """
+    Serialize an API object, or a list of them, to a compact binary string.
+    Connections are not serialized; objects shared by reference (eg. Networks
+    interned with an IdentityMap) stay shared after loads().
+
+    :type codec: string
+    :param codec: "msgpack" or "pickle"; defaults to msgpack if it's installed
+
+    :rtype: bytes
+    """
+
+    if codec is None:
+        codec = "msgpack" if msgpack is not None else "pickle"
+
+    if codec == "pickle":
+        # pickle handles object graphs natively, APIObject.__getstate__
+        # leaves out the connection
+        return MAGIC + PICKLE + pickle.dumps(objects, pickle.HIGHEST_PROTOCOL)
+    if codec == "msgpack":
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+        payload = _encode(objects, {})
+        return MAGIC + MSGPACK + msgpack.packb(payload, use_bin_type=True)
+
+    raise ValueError("Unknown codec: %s" % codec)
+
+
+def loads(data, conn=None):
+    """
+    Deserialize objects serialized by dumps() and attach them to `conn`.
+
+    :type conn: TiktalikAuthConnection
+    :param conn: connection the loaded objects will use, may be None
+
+    :return: an API object or a list of them, as passed to dumps()
+    """
+
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not a serialized tiktalik object")
+
+    codec = data[len(MAGIC) : len(MAGIC) + 1]
+    payload = data[len(MAGIC) + 1 :]
+    if codec == PICKLE:
+        objects = pickle.loads(payload)
+    elif codec == MSGPACK:
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+        objects = _decode(msgpack.unpackb(payload, raw=False), {})
+    else:
+        raise ValueError("Unknown codec: %r" % codec)
+
+    if conn is not None:
+        for obj in objects if isinstance(objects, list) else [objects]:
+            if isinstance(obj, APIObject):
+                obj.rebind(conn)
+    return objects
+
+
+def _encode(value, memo):
+    if isinstance(value, APIObject):
+        ref = memo.get(id(value))
+        if ref is not None:
+            return {_REF: ref}
+        memo[id(value)] = ref = len(memo)
+
+        ret = {_TYPE: type(value).__name__, _ID: ref}
+        for k, v in value.__dict__.items():
+            if k != "conn":
+                ret[k] = _encode(v, memo)
+        return ret
+    if isinstance(value, (list, tuple, deque)):
+        # an ActionHistory becomes a plain list, as when pickled
+        return [_encode(v, memo) for v in value]
+    return value
+
+
+def _decode(value, memo):
+    if isinstance(value, list):
+        return [_decode(v, memo) for v in value]
+    if isinstance(value, dict):
+        if _REF in value:
+            return memo[value[_REF]]
+        if _TYPE in value:
+            cls = _classes[value.pop(_TYPE)]
+            # bypass __init__: nested objects are decoded already
+            obj = cls.__new__(cls)
+            memo[value.pop(_ID)] = obj
+            obj.__dict__.update((k, _decode(v, memo)) for (k, v) in value.items())
+            return obj
+    return value
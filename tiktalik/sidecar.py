@@ -0,0 +1,477 @@
+"""Module tiktalik.sidecar"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import os
+import sys
+import stat
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+
+from .error import TiktalikAPIError, TiktalikTimeoutError
+from .connection import TiktalikAuthConnection, PreparedRequest
+
+__all__ = ["InventoryServer", "SidecarClient", "main"]
+
+
+# in a directory only the user can access: $XDG_RUNTIME_DIR, or
+# ~/.cache/tiktalik created with mode 0700 by the server
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR")
+    or os.path.join(os.path.expanduser("~"), ".cache", "tiktalik"),
+    "tiktalik-sidecar.sock",
+)
+
+# GET requests kept warm from the start: the instance, network, image and
+# load balancer lists, as requested by the list_* methods with default
+# arguments
+INVENTORY = (
+    (
+        "/api/v1/computing/instance",
+        {"actions": False, "vpsimage": False, "cost": False},
+    ),
+    ("/api/v1/computing/network", None),
+    ("/api/v1/computing/image", None),
+    ("/api/v1/loadbalancer", {"history": False}),
+)
+
+
+class _Upstream(TiktalikAuthConnection):
+    # requests forwarded by the sidecar carry full paths already
+    def base_url(self):
+        return ""
+
+
+class InventoryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves API requests of local processes over a Unix socket, from a cache
+    of GET replies kept warm in the background. See SidecarClient, or pass
+    `sidecar` to a connection, for the client side.
+
+    Requests are signed with the credentials the server was started with, so
+    the socket is only accessible to the user running it, and requests of
+    clients using a different API key are refused with a 403 rather than
+    served from this account.
+
+    - a GET reply is cached for `ttl` seconds; concurrent requests for the
+      same path wait for one upstream request
+    - paths requested within the last `idle` seconds, and the INVENTORY
+      lists, are refreshed every `refresh` seconds, so they're served from
+      memory without waiting
+    - other methods are forwarded as they are and invalidate all cached
+      replies of the same API (computing or loadbalancer), which are then
+      fetched again in the background
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path,
+        api_key,
+        api_secret_key,
+        host="tiktalik.com",
+        port=443,
+        use_ssl=True,
+        ttl=60.0,
+        refresh=20.0,
+        idle=600.0,
+        pool_size=8,
+    ):
+        self.upstream = _Upstream(
+            api_key,
+            api_secret_key,
+            host,
+            port,
+            use_ssl,
+            keep_alive=True,
+            pool_size=pool_size,
+        )
+        self.ttl = ttl
+        self.refresh = refresh
+        self.idle = idle
+
+        # path -> (fetched at, data); path -> last requested
+        self._cache = {}
+        self._used = {}
+        self._fetching = {}
+        # bumped by invalidate(), replies fetched before aren't cached
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self.hits = 0
+        self.misses = 0
+
+        for path, query in INVENTORY:
+            prepared = self.upstream.prepare("GET", path, query_params=query)
+            self._used[prepared.path] = None
+
+        directory = os.path.dirname(os.path.abspath(socket_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        try:
+            st = os.lstat(socket_path)
+        except FileNotFoundError:
+            pass
+        else:
+            # a socket left by an earlier server; anything else isn't ours
+            # to remove
+            if not stat.S_ISSOCK(st.st_mode) or not _owned(st):
+                raise OSError("%s exists and isn't our socket" % socket_path)
+            os.unlink(socket_path)
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, _Handler)
+        finally:
+            os.umask(umask)
+
+        self._refresher = threading.Thread(target=self._refresh_loop)
+        self._refresher.daemon = True
+        self._refresher.start()
+        # warm up right away
+        self._wake.set()
+
+    def server_close(self):
+        self._stopped = True
+        self._wake.set()
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+        self.upstream.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, cached=len(self._cache))
+
+    def handle_message(self, message):
+        """
+        :type message: dict
+        :param message: a PreparedRequest as a dict, with optional "timeout"
+
+        :rtype: dict
+        :return: dict(status=int, data=reply), or dict(timeout=[phase, limit])
+        """
+
+        if message.get("op") == "stats":
+            return dict(status=200, data=self.stats())
+
+        if message.get("api_key") != self.upstream.api_key:
+            return dict(
+                status=403,
+                data=dict(description="API key doesn't match the sidecar's"),
+            )
+
+        prepared = PreparedRequest(
+            message["method"],
+            message["path"],
+            message.get("body"),
+            message.get("headers") or {},
+        )
+        timeout = message.get("timeout")
+
+        try:
+            if prepared.method == "GET":
+                data = self._get(prepared, timeout)
+            else:
+                try:
+                    data = self.upstream.send(prepared, timeout)
+                finally:
+                    self.invalidate(_family(prepared.path))
+        except TiktalikTimeoutError as e:
+            return dict(timeout=list(e.args))
+        except TiktalikAPIError as e:
+            return dict(status=e.http_status, data=_text(e.data))
+        except Exception as e:
+            return dict(status=502, data=dict(description=str(e)))
+
+        return dict(status=200, data=_text(data))
+
+    def invalidate(self, prefix=""):
+        """
+        Drop cached replies of paths starting with `prefix`, and refresh them
+        in the background.
+        """
+
+        with self._lock:
+            self._generation += 1
+            for path in list(self._cache):
+                if path.startswith(prefix):
+                    del self._cache[path]
+        self._wake.set()
+
+    def _get(self, prepared, timeout):
+        path = prepared.path
+        while True:
+            with self._lock:
+                if self._used.get(path, 0) is not None:
+                    self._used[path] = time.monotonic()
+                entry = self._cache.get(path)
+                if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                    self.hits += 1
+                    return entry[1]
+
+                pending = self._fetching.get(path)
+                if pending is None:
+                    self.misses += 1
+                    pending = self._fetching[path] = threading.Event()
+                    break
+
+            # another thread is fetching this path
+            pending.wait(timeout)
+            if timeout is not None and not pending.is_set():
+                raise TiktalikTimeoutError("first_byte", timeout)
+            with self._lock:
+                entry = self._cache.get(path)
+                if entry is not None:
+                    self.hits += 1
+                    return entry[1]
+
+        try:
+            return self._fetch(prepared, timeout)
+        finally:
+            with self._lock:
+                del self._fetching[path]
+            pending.set()
+
+    def _fetch(self, prepared, timeout=None):
+        with self._lock:
+            generation = self._generation
+        fetched = time.monotonic()
+        data = self.upstream.send(prepared, timeout)
+        with self._lock:
+            if generation == self._generation:
+                self._cache[prepared.path] = (fetched, data)
+        return data
+
+    def _refresh_loop(self):
+        while not self._stopped:
+            self._wake.wait(self.refresh)
+            self._wake.clear()
+            if self._stopped:
+                return
+
+            now = time.monotonic()
+            with self._lock:
+                paths = []
+                for path, used in list(self._used.items()):
+                    if used is not None and now - used > self.idle:
+                        del self._used[path]
+                        self._cache.pop(path, None)
+                    else:
+                        paths.append(path)
+
+            for path in paths:
+                try:
+                    self._fetch(PreparedRequest("GET", path, None, {}))
+                except Exception:
+                    # served by a regular upstream request on the next miss
+                    pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.handle_message(json.loads(line.decode("utf8")))
+                reply = json.dumps(response)
+            except Exception as e:
+                reply = json.dumps(dict(status=400, data=dict(description=str(e))))
+            self.wfile.write(reply.encode("utf8") + b"\n")
+            self.wfile.flush()
+
+
+class SidecarClient:
+    """
+    Sends requests to an InventoryServer. Connections use it in place of HTTP
+    when created with `sidecar` set to the socket path. Each thread keeps
+    its own connection to the socket.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=20):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def send(self, prepared, deadline=None, api_key=None):
+        """
+        :type prepared: PreparedRequest
+        :param prepared: the request, signed by the server
+
+        :type api_key: string
+        :param api_key: API key of the calling connection; the server refuses
+                        requests if it differs from its own
+
+        :rtype: tuple
+        :return: (HTTP status, decoded reply)
+        """
+
+        timeout = self.timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline.check("send"))
+
+        message = dict(
+            method=prepared.method,
+            path=prepared.path,
+            body=prepared.body,
+            headers=prepared.headers,
+            timeout=timeout,
+            api_key=api_key,
+        )
+        response = self._exchange(
+            json.dumps(message).encode("utf8") + b"\n",
+            timeout,
+            # other methods may have been performed already
+            retry=prepared.method == "GET",
+        )
+
+        if "timeout" in response:
+            raise TiktalikTimeoutError(*response["timeout"])
+        return response["status"], response["data"]
+
+    def stats(self):
+        """
+        :rtype: dict
+        :return: cache hits, misses and number of cached replies of the server
+        """
+
+        return self._exchange(b'{"op": "stats"}\n', self.timeout)["data"]
+
+    def _exchange(self, line, timeout, retry=True):
+        """
+        Send `line`, return the decoded reply. A connection reused from an
+        earlier call may have been closed by a restarted server: if sending
+        fails, or for `retry` requests if no reply comes, it's sent again on
+        a new connection.
+        """
+
+        for attempt in (0, 1):
+            sock = getattr(self._local, "sock", None)
+            reused = sock is not None
+            if sock is None:
+                # don't send requests to a socket another user created
+                if not _owned(os.stat(self.socket_path)):
+                    raise PermissionError(
+                        "%s isn't owned by the current user" % self.socket_path
+                    )
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(timeout)
+                sock.connect(self.socket_path)
+                self._local.sock = sock
+                self._local.file = sock.makefile("rb")
+
+            try:
+                sock.settimeout(timeout)
+                sock.sendall(line)
+            except socket.timeout:
+                self._close()
+                raise TiktalikTimeoutError("send", timeout)
+            except OSError:
+                self._close()
+                if not reused:
+                    raise
+                continue
+
+            try:
+                reply = self._local.file.readline()
+                if not reply:
+                    raise ConnectionResetError("sidecar closed the connection")
+                return json.loads(reply.decode("utf8"))
+            except socket.timeout:
+                self._close()
+                raise TiktalikTimeoutError("first_byte", timeout)
+            except OSError:
+                self._close()
+                if not (reused and retry):
+                    raise
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            self._local.file.close()
+            sock.close()
+        self._local.sock = None
+
+
+def _owned(st):
+    return not hasattr(os, "getuid") or st.st_uid == os.getuid()
+
+
+def _text(data):
+    if isinstance(data, bytes):
+        return data.decode("utf8", "replace")
+    return data
+
+
+def _family(path):
+    """
+    "/api/v1/computing/instance/x" -> "/api/v1/computing"
+    """
+
+    return "/".join(path.split("?", 1)[0].split("/")[:4])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m tiktalik.sidecar",
+        description="Serve cached Tiktalik API state to local processes. "
+        "Credentials are read from TIKTALIK_API_KEY and TIKTALIK_API_SECRET_KEY.",
+    )
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--host", default="tiktalik.com")
+    parser.add_argument("--port", type=int, default=443)
+    parser.add_argument("--no-ssl", dest="use_ssl", action="store_false")
+    parser.add_argument("--ttl", type=float, default=60.0)
+    parser.add_argument("--refresh", type=float, default=20.0)
+    args = parser.parse_args(argv)
+
+    try:
+        api_key = os.environ["TIKTALIK_API_KEY"]
+        api_secret_key = os.environ["TIKTALIK_API_SECRET_KEY"]
+    except KeyError as e:
+        parser.error("%s is not set" % e.args[0])
+
+    server = InventoryServer(
+        args.socket,
+        api_key,
+        api_secret_key,
+        args.host,
+        args.port,
+        args.use_ssl,
+        ttl=args.ttl,
+        refresh=args.refresh,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+"""Module tiktalik.tracing"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import time
+import socket
+import logging
+import threading
+import http.client
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+__all__ = ["RequestTrace", "Tracer", "traced", "current_trace", "trace_context"]
+
+
+log = logging.getLogger("tiktalik.trace")
+
+# Phases recorded for a request, in order.
+PHASES = ("queue", "dns", "connect", "tls", "send", "ttfb", "read", "decode", "build")
+
+
+if contextvars is not None:
+    # Applications may set this to their current span (or any object that
+    # identifies it); traces started while it's set keep it as `parent`.
+    trace_context = contextvars.ContextVar("tiktalik_trace_context", default=None)
+    _current = contextvars.ContextVar("tiktalik_current_trace", default=None)
+
+    def current_trace():
+        """
+        :rtype: RequestTrace
+        :return: the trace of the API call in progress in this context, or None
+        """
+
+        return _current.get()
+
+    def _set_current(trace):
+        return _current.set(trace)
+
+    def _reset_current(token):
+        _current.reset(token)
+
+    def _parent():
+        return trace_context.get()
+
+
+else:
+    trace_context = None
+    _local = threading.local()
+
+    def current_trace():
+        """
+        :rtype: RequestTrace
+        :return: the trace of the API call in progress in this thread, or None
+        """
+
+        return getattr(_local, "trace", None)
+
+    def _set_current(trace):
+        token = current_trace()
+        _local.trace = trace
+        return token
+
+    def _reset_current(token):
+        _local.trace = token
+
+    def _parent():
+        return None
+
+
+class RequestTrace:
+    """
+    Timing breakdown of an API call.
+
+    Attributes:
+        name: string - connection method name, or "METHOD path" for raw requests
+        phases: OrderedDict - phase name -> seconds, see PHASES; phases
+                of all requests made by the call are summed up
+        requests: int - number of HTTP requests made
+        status: int - HTTP status of the last response
+        total: float - duration of the whole call, in seconds
+        error: Exception - exception raised by the call, if any
+        parent: object - value of trace_context when the call started
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = OrderedDict()
+        self.requests = 0
+        self.status = None
+        self.error = None
+        self.total = None
+        self.parent = _parent()
+        self.builds = False
+        self.start = time.monotonic()
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def __str__(self):
+        phases = " ".join(
+            "%s=%.1fms" % (k, v * 1000) for (k, v) in self.phases.items()
+        )
+        return "<RequestTrace: %s status=%s total=%.1fms %s>" % (
+            self.name,
+            self.status,
+            (self.total or 0) * 1000,
+            phases,
+        )
+
+
+class Tracer:
+    """
+    Collects RequestTraces of API calls. Pass an instance as `tracer` to
+    a connection to enable tracing.
+
+    :type on_trace: callable
+    :param on_trace: called with every finished RequestTrace
+
+    :type slow_threshold: float
+    :param slow_threshold: calls that take at least this many seconds are
+                           logged as warnings to the "tiktalik.trace" logger
+    """
+
+    def __init__(self, on_trace=None, slow_threshold=None):
+        self.on_trace = on_trace
+        self.slow_threshold = slow_threshold
+
+    @contextmanager
+    def call(self, name, builds=True):
+        """
+        Trace an API call. Nested calls are recorded in the outer trace.
+
+        With `builds`, time not spent on HTTP requests and decoding is
+        recorded as the "build" phase - building objects from the reply.
+        """
+
+        trace = current_trace()
+        if trace is not None:
+            yield trace
+            return
+
+        trace = RequestTrace(name)
+        trace.builds = builds
+        token = _set_current(trace)
+        try:
+            yield trace
+        except Exception as e:
+            trace.error = e
+            raise
+        finally:
+            _reset_current(token)
+            self.finish(trace)
+
+    def finish(self, trace):
+        trace.total = time.monotonic() - trace.start
+
+        # whatever the call spent outside of HTTP requests and JSON decoding
+        # went to building objects from the reply
+        if trace.builds and trace.requests and "build" not in trace.phases:
+            build = trace.total - sum(trace.phases.values())
+            if build > 0:
+                trace.add("build", build)
+
+        if self.slow_threshold is not None and trace.total >= self.slow_threshold:
+            log.warning("slow request: %s", trace)
+
+        if self.on_trace is not None:
+            self.on_trace(trace)
+
+
+def traced(method):
+    """
+    Decorator for connection methods: trace the whole call, including
+    building objects from the response, when the connection has a tracer.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        tracer = self.tracer
+        if tracer is None:
+            return method(self, *args, **kwargs)
+        with tracer.call(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def connect(conn, trace):
+    """
+    Open the socket of an HTTP(S)Connection with conn.connect(), timing name
+    resolution, the TCP handshake and the rest (the TLS handshake and, with
+    set_tunnel(), the proxy CONNECT) separately.
+    """
+
+    timings = {"dns": 0.0, "connect": 0.0}
+    create = conn._create_connection
+
+    def timed_create(address, timeout=None, source_address=None, *args, **kwargs):
+        host, port = address[:2]
+        start = time.monotonic()
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        now = time.monotonic()
+        timings["dns"] += now - start
+
+        error = None
+        try:
+            for info in infos:
+                try:
+                    return create(
+                        info[4][:2], timeout, source_address, *args, **kwargs
+                    )
+                except OSError as e:
+                    error = e
+            raise error or OSError("getaddrinfo returned an empty list")
+        finally:
+            timings["connect"] += time.monotonic() - now
+
+    start = time.monotonic()
+    conn._create_connection = timed_create
+    try:
+        conn.connect()
+    finally:
+        conn._create_connection = create
+        total = time.monotonic() - start
+        trace.add("dns", timings["dns"])
+        trace.add("connect", timings["connect"])
+        rest = max(0.0, total - timings["dns"] - timings["connect"])
+        if isinstance(conn, http.client.HTTPSConnection):
+            trace.add("tls", rest)
+        else:
+            trace.add("connect", rest)
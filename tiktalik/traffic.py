@@ -0,0 +1,475 @@
+"""Module tiktalik.traffic"""
+# Copyright (c) 2013 Techstorage sp. z o.o.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# -*- coding: utf8 -*-
+
+import re
+import sys
+import gzip
+import json
+import time
+import argparse
+import threading
+import http.server
+import socketserver
+from hashlib import md5
+from urllib import parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .connection import TiktalikAuthConnection, PreparedRequest
+
+__all__ = [
+    "TrafficRecorder",
+    "load_capture",
+    "StandInServer",
+    "Replayer",
+    "ReplayReport",
+    "main",
+]
+
+
+# Values of these fields are replaced with REDACTED in request bodies and
+# replies. Credentials never get to the capture: the Authorization header
+# isn't recorded at all.
+REDACTED_FIELDS = frozenset(
+    ("password", "default_password", "ssh_key", "api_key", "secret", "token")
+)
+REDACTED = "***"
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf8")
+    return open(path, mode, encoding="utf8")
+
+
+def _redact(value, fields):
+    if isinstance(value, dict):
+        return dict(
+            (k, REDACTED if k in fields else _redact(v, fields))
+            for (k, v) in value.items()
+        )
+    if isinstance(value, list):
+        return [_redact(v, fields) for v in value]
+    return value
+
+
+class TrafficRecorder:
+    """
+    Records API traffic to a capture file, one JSON object per line
+    (gzip-compressed if the name ends with ".gz"). Pass an instance as
+    `recorder` to connections to record all their requests:
+
+        with TrafficRecorder("capture.jsonl.gz") as recorder:
+            conn = ComputingConnection(key, secret, recorder=recorder)
+            ...
+
+    Each entry has the time since the start of recording ("t"), method ("m"),
+    path ("p"), query string ("q"), request body ("rb"), HTTP status ("s"),
+    time to the response headers ("h") and total duration ("d") in seconds,
+    and the reply ("b") unless `bodies` is False. Fields named in `redact`
+    are masked in request bodies and JSON replies. Replies of make_request()
+    calls aren't read by the connection, so they're not recorded.
+    """
+
+    def __init__(self, path, bodies=True, redact=REDACTED_FIELDS):
+        self.path = path
+        self.bodies = bodies
+        self.redact = frozenset(redact)
+        self.count = 0
+
+        self._file = _open(path, "w")
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record(self, prepared, start, headers_at, end, status, data=None, error=None):
+        """
+        Add an entry for `prepared`. Times are time.monotonic() values.
+        """
+
+        path, _, query = prepared.path.partition("?")
+        entry = OrderedDict(
+            (
+                ("t", round(start - self._start, 6)),
+                ("m", prepared.method),
+                ("p", path),
+                ("q", query),
+                ("s", status),
+                ("h", round(headers_at - start, 6) if headers_at else None),
+                ("d", round(end - start, 6)),
+            )
+        )
+        if prepared.body:
+            entry["rb"] = self._redact_body(prepared.body)
+            entry["ct"] = prepared.headers.get("content-type")
+        if error is not None:
+            entry["e"] = type(error).__name__
+        if self.bodies and data is not None:
+            entry["b"] = self._redact_reply(data)
+
+        line = json.dumps(entry, separators=(",", ":"))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+                self.count += 1
+
+    def _redact_body(self, body):
+        params = parse.parse_qsl(body, keep_blank_values=True)
+        if not any(k.rstrip("[]") in self.redact for (k, _) in params):
+            return body
+        return parse.urlencode(
+            [(k, REDACTED if k.rstrip("[]") in self.redact else v) for (k, v) in params]
+        )
+
+    def _redact_reply(self, data):
+        text = data.decode("utf8", "replace") if isinstance(data, bytes) else data
+        try:
+            value = json.loads(text)
+        except ValueError:
+            return text
+        return json.dumps(_redact(value, self.redact), separators=(",", ":"))
+
+
+def load_capture(path):
+    """
+    :rtype: list
+    :return: entries of a capture file, as dicts, in order of their start time
+    """
+
+    with _open(path, "r") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda e: e["t"])
+    return entries
+
+
+try:
+    _ThreadingHTTPServer = http.server.ThreadingHTTPServer
+except AttributeError:
+    # Python < 3.7
+    class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+
+class StandInServer(_ThreadingHTTPServer):
+    """
+    A local HTTP server answering requests with the replies from a capture.
+    Replies for the same method and path are served in recorded order, in
+    a loop; unknown requests get a 404. Each reply is delayed by its recorded
+    duration times `latency_scale`.
+
+        server = StandInServer(load_capture("capture.jsonl.gz"))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, entries, address=("127.0.0.1", 0), latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.replies = {}
+        for e in entries:
+            key = (e["m"], e["p"] + ("?" + e["q"] if e["q"] else ""))
+            self.replies.setdefault(key, []).append(e)
+        self._next = dict((k, 0) for k in self.replies)
+        self._lock = threading.Lock()
+        super(StandInServer, self).__init__(address, _StandInHandler)
+
+    def reply(self, method, path):
+        with self._lock:
+            replies = self.replies.get((method, path))
+            if not replies:
+                return None
+            i = self._next[(method, path)]
+            self._next[(method, path)] = (i + 1) % len(replies)
+            return replies[i]
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, don't let them wait for an ACK
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        entry = self.server.reply(self.command, self.path)
+        if entry is None:
+            status, body = 404, '{"description": "not in capture"}'
+        else:
+            status, body = entry["s"] or 502, entry.get("b") or ""
+            delay = (entry.get("h") or entry["d"]) * self.server.latency_scale
+            if delay > 0:
+                time.sleep(delay)
+
+        body = body.encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class _Raw(TiktalikAuthConnection):
+    # captured paths include the base URL already
+    def base_url(self):
+        return ""
+
+
+_ID = re.compile(r"/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def endpoint(entry):
+    """
+    :return: "METHOD path" of a capture entry, with UUIDs replaced by ":id"
+    """
+
+    return "%s %s" % (entry["m"], _ID.sub("/:id", entry["p"]))
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class ReplayReport:
+    """
+    Outcome of Replayer.run().
+
+    Attributes:
+        requests: int
+        errors: int - network errors and HTTP status different from the capture
+        duration: float - wall clock time of the replay, in seconds
+        throughput: float - requests per second
+        latencies: dict - endpoint (see endpoint()) -> sorted list of
+                   latencies in seconds; "*" for all requests
+        lag: List[float] - how late requests were sent compared to the
+             schedule, sorted; high values mean `concurrency` is too low
+    """
+
+    def __init__(self, requests, errors, duration, latencies, lag):
+        self.requests = requests
+        self.errors = errors
+        self.duration = duration
+        self.throughput = requests / duration if duration else 0.0
+        self.latencies = latencies
+        self.lag = lag
+
+    def percentiles(self, endpoint="*", points=(50, 90, 99, 100)):
+        """
+        :rtype: dict
+        :return: percentile -> latency in seconds
+        """
+
+        values = self.latencies.get(endpoint, [])
+        return OrderedDict((p, _percentile(values, p)) for p in points)
+
+    def format(self):
+        """
+        :rtype: string
+        :return: the report as a table
+        """
+
+        lines = [
+            "%d requests in %.2fs, %.1f req/s, %d errors, p99 lag %.1fms"
+            % (
+                self.requests,
+                self.duration,
+                self.throughput,
+                self.errors,
+                (_percentile(self.lag, 99) or 0) * 1000,
+            ),
+            "",
+            "%-50s %7s %9s %9s %9s %9s"
+            % ("endpoint", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"),
+        ]
+        names = sorted(self.latencies, key=lambda k: (k != "*", k))
+        for name in names:
+            if not self.latencies[name]:
+                # nothing was replayed
+                continue
+            ms = tuple(v * 1000 for v in self.percentiles(name).values())
+            lines.append(
+                "%-50s %7d %9.1f %9.1f %9.1f %9.1f"
+                % ((name, len(self.latencies[name])) + ms)
+            )
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.format()
+
+
+class Replayer:
+    """
+    Sends the requests of a capture again, keeping their relative timing.
+
+    :type conn: TiktalikAuthConnection
+    :param conn: connection to send requests with, eg. to a StandInServer;
+                 only its host, port, credentials and pooling are used
+
+    :type speed: float
+    :param speed: 1 replays at the recorded pace, 10 ten times faster, None
+                  sends requests as fast as `concurrency` allows
+
+    :type concurrency: int
+    :param concurrency: maximum number of requests in progress
+    """
+
+    def __init__(self, entries, conn, speed=1.0, concurrency=8):
+        self.entries = entries
+        self.conn = conn
+        self.speed = speed
+        self.concurrency = concurrency
+
+    def run(self):
+        """
+        :rtype: ReplayReport
+        """
+
+        latencies = {"*": []}
+        lag = []
+        errors = [0]
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.concurrency)
+
+        def send(entry, due):
+            try:
+                start = time.monotonic()
+                status = self._send(entry)
+                latency = time.monotonic() - start
+            finally:
+                slots.release()
+            with lock:
+                lag.append(max(0.0, start - due) if due is not None else 0.0)
+                latencies["*"].append(latency)
+                latencies.setdefault(endpoint(entry), []).append(latency)
+                if status != entry["s"]:
+                    errors[0] += 1
+
+        begin = time.monotonic()
+        first = self.entries[0]["t"] if self.entries else 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for entry in self.entries:
+                due = None
+                if self.speed:
+                    due = begin + (entry["t"] - first) / self.speed
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                slots.acquire()
+                executor.submit(send, entry, due)
+        duration = time.monotonic() - begin
+
+        for values in latencies.values():
+            values.sort()
+        lag.sort()
+        return ReplayReport(len(self.entries), errors[0], duration, latencies, lag)
+
+    def _send(self, entry):
+        """
+        :return: HTTP status of the reply, None on network errors
+        """
+
+        path = entry["p"] + ("?" + entry["q"] if entry["q"] else "")
+        headers = {}
+        body = entry.get("rb")
+        if body:
+            headers["content-type"] = entry.get("ct") or (
+                "application/x-www-form-urlencoded"
+            )
+            headers["content-md5"] = md5(body.encode("utf-8")).hexdigest()
+
+        prepared = PreparedRequest(entry["m"], path, body, headers)
+        try:
+            response, _ = self.conn._perform(prepared, self.conn._deadline(None))
+        except Exception:
+            return None
+        return response.status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m tiktalik.traffic",
+        description="Replay a traffic capture against a local stand-in server "
+        "and report throughput and latency.",
+    )
+    parser.add_argument("capture")
+    parser.add_argument(
+        "--speed",
+        default="1",
+        help='replay speed: 1, 10, ... or "max" for unthrottled (default: 1)',
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="stand-in reply delay, as a fraction of the recorded one",
+    )
+    parser.add_argument("--pool-size", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    entries = load_capture(args.capture)
+    speed = None if args.speed == "max" else float(args.speed)
+
+    server = StandInServer(entries, latency_scale=args.latency_scale)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        host, port = server.server_address[:2]
+        # the stand-in doesn't check signatures
+        conn = _Raw(
+            "replay",
+            "cmVwbGF5",
+            host,
+            port,
+            use_ssl=False,
+            keep_alive=True,
+            pool_size=args.pool_size,
+        )
+        report = Replayer(entries, conn, speed, args.concurrency).run()
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print(report.format())
+
+
+if __name__ == "__main__":
+    sys.exit(main())